@@ -1,4 +1,7 @@
 import os
+import re
+from functools import lru_cache
+from pydantic import Field
 from pydantic_settings import BaseSettings
 from typing import Optional
 
@@ -12,6 +15,7 @@ class Settings(BaseSettings):
     SECRET_KEY: str = os.getenv("SECRET_KEY", "your-secret-key-change-in-production")
     ALGORITHM: str = "HS256"
     ACCESS_TOKEN_EXPIRE_MINUTES: int = 60 * 24  # 24 hours
+    BCRYPT_ROUNDS: int = int(os.getenv("BCRYPT_ROUNDS", "10"))  # Cost factor for new password hashes
     
     # CRITICAL: OpenAI/Claude API Key for AI Triage
     OPENAI_API_KEY: str = os.getenv("OPENAI_API_KEY", "")
@@ -23,6 +27,10 @@ class Settings(BaseSettings):
     ANTHROPIC_MODEL: str = "claude-sonnet-4-20250514"
     AI_MAX_TOKENS: int = 2000
     AI_TEMPERATURE: float = 0.3  # Lower for more consistent medical analysis
+    AI_MAX_CONCURRENCY: int = 8  # Provider requests in flight at once per worker
+    AI_MAX_ATTEMPTS: int = Field(4, ge=1)  # Tries per assessment on rate limits, 5xx, connection errors and timeouts
+    AI_ATTEMPT_TIMEOUT: float = Field(25.0, gt=0)  # Seconds per provider request, so a timed-out try leaves room to retry
+    AI_REQUEST_DEADLINE: float = Field(60.0, gt=0)  # Seconds for all attempts (queueing and backoff included) before the fallback
     
     # Firebase Configuration
     FIREBASE_CREDENTIALS_PATH: str = os.getenv("FIREBASE_CREDENTIALS_PATH", "firebase-credentials.json")
@@ -36,6 +44,8 @@ class Settings(BaseSettings):
     
     # Fallback AI Settings (if API keys not available)
     USE_FALLBACK_AI: bool = os.getenv("USE_FALLBACK_AI", "false").lower() == "true"
+    NLP_MODEL: str = os.getenv("NLP_MODEL", "en_core_web_sm")  # SpaCy pipeline for the rule-based engine
+    MAX_SYMPTOM_TEXT_LENGTH: int = 2000  # Characters the rule-based engine scans per request
     
     # Severity Thresholds
     NORMAL_MAX: int = 39
@@ -44,24 +54,46 @@ class Settings(BaseSettings):
     CRITICAL_MIN: int = 70
     
     # Emergency Keywords (Rule-based overrides)
-    EMERGENCY_KEYWORDS: list = [
+    EMERGENCY_KEYWORDS: tuple = (
         "chest pain", "difficulty breathing", "unconscious", "severe bleeding",
         "stroke symptoms", "heart attack", "seizure", "suicide", "overdose",
         "severe head injury", "choking", "anaphylaxis", "severe burns"
-    ]
+    )
     
     # CORS Settings
-    CORS_ORIGINS: list = [
+    CORS_ORIGINS: tuple = (
         "http://localhost:3000",
         "http://localhost:3001",
         "https://your-frontend-domain.com"
-    ]
+    )
+    
+    # Queue Settings
+    QUEUE_VIEW_REFRESH_INTERVAL: int = 300  # Seconds between full rebuilds of the active queue view
+    QUEUE_RECONCILE_INTERVAL: int = 30  # Seconds between re-reads of the queue into the local cache
     
     # WebSocket Settings
     WS_HEARTBEAT_INTERVAL: int = 30
+    WS_SEND_QUEUE_SIZE: int = 32  # Frames buffered per client before dropping the oldest
+    BROADCAST_URL: str = os.getenv("BROADCAST_URL", "memory://")  # e.g. "redis://localhost:6379" for multi-worker
     
     class Config:
         env_file = ".env"
         case_sensitive = True
+        frozen = True  # Settings are read-only after startup
+
+@lru_cache
+def get_settings() -> Settings:
+    """Build settings once per process; later calls reuse the same instance"""
+    return Settings()
+
+# Built eagerly on purpose: model field limits and EMERGENCY_KEYWORD_PATTERN read
+# settings at import. Tests that change env call get_settings.cache_clear()
+# and construct Settings() directly.
+settings = get_settings()
 
-settings = Settings()
\ No newline at end of file
+# All emergency keywords compiled into one alternation so triage scans the
+# text once instead of once per keyword (longest first so the more specific
+# phrase wins when keywords share a prefix)
+EMERGENCY_KEYWORD_PATTERN = re.compile(
+    "|".join(re.escape(k) for k in sorted(settings.EMERGENCY_KEYWORDS, key=len, reverse=True))
+)
\ No newline at end of file
@@ -1,16 +1,25 @@
 from fastapi import FastAPI, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse
 from config import settings
 from routes import auth, patient, triage, doctor
+from broadcaster import Broadcast
+from concurrent.futures import ThreadPoolExecutor
 import asyncio
-from typing import List
-import json
+import logging
+import os
+import time
+from typing import Awaitable, Callable, Dict, Optional, Set
+import orjson
+
+logger = logging.getLogger(__name__)
 
 # Initialize FastAPI app
 app = FastAPI(
     title=settings.API_TITLE,
     version=settings.API_VERSION,
-    description="AI-powered Smart Triage & Virtual Health Assistant System"
+    description="AI-powered Smart Triage & Virtual Health Assistant System",
+    default_response_class=ORJSONResponse
 )
 
 # CORS Configuration
@@ -28,59 +37,166 @@ app.include_router(patient.router, prefix=settings.API_PREFIX)
 app.include_router(triage.router, prefix=settings.API_PREFIX)
 app.include_router(doctor.router, prefix=settings.API_PREFIX)
 
+def encode_message(message: dict) -> str:
+    """Serialize a WebSocket message once (datetimes from Firestore included)"""
+    return orjson.dumps(message, default=str).decode()
+
+# Pub/sub layer so broadcasts reach sockets held by every uvicorn worker.
+# "memory://" keeps delivery in-process; point BROADCAST_URL at redis:// to scale out.
+broadcaster = Broadcast(settings.BROADCAST_URL)
+
+# Topics a WebSocket client can subscribe to; each maps to one pub/sub channel
+TOPICS = ("queue", "alerts")
+
+def topic_channel(topic: str) -> str:
+    return f"ws:{topic}"
+
+# Per-connection sender with a bounded queue
+class SendWorker:
+    def __init__(self, websocket: WebSocket, on_dead: Callable[[WebSocket], None], topics: Set[str]):
+        self.websocket = websocket
+        self.on_dead = on_dead
+        self.topics = topics
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=settings.WS_SEND_QUEUE_SIZE)
+        self.task = asyncio.create_task(self._run())
+    
+    def enqueue(self, payload: str):
+        """Queue a frame, dropping the oldest one if the client is falling behind"""
+        try:
+            self.queue.put_nowait(payload)
+        except asyncio.QueueFull:
+            self.queue.get_nowait()
+            self.queue.put_nowait(payload)
+    
+    async def _run(self):
+        """Drain the queue to the socket until a send fails"""
+        try:
+            while True:
+                payload = await self.queue.get()
+                await self.websocket.send_text(payload)
+        except Exception:
+            self.on_dead(self.websocket)
+    
+    def close(self):
+        self.task.cancel()
+
 # WebSocket connection manager
 class ConnectionManager:
     def __init__(self):
-        self.active_connections: List[WebSocket] = []
+        self.active_connections: Dict[WebSocket, SendWorker] = {}
     
-    async def connect(self, websocket: WebSocket):
+    async def connect(self, websocket: WebSocket, topics: Set[str]):
         await websocket.accept()
-        self.active_connections.append(websocket)
+        self.active_connections[websocket] = SendWorker(websocket, self.disconnect, set(topics))
     
     def disconnect(self, websocket: WebSocket):
-        self.active_connections.remove(websocket)
+        # No-op if the socket's sender already removed it after a failed send
+        worker = self.active_connections.pop(websocket, None)
+        if worker:
+            worker.close()
     
-    async def broadcast(self, message: dict):
-        """Broadcast message to all connected clients"""
-        for connection in self.active_connections:
-            try:
-                await connection.send_json(message)
-            except:
-                pass
+    def subscriptions(self, websocket: WebSocket) -> Set[str]:
+        worker = self.active_connections.get(websocket)
+        return set(worker.topics) if worker else set()
+    
+    def subscribe(self, websocket: WebSocket, topics: Set[str]) -> Set[str]:
+        """Add topics for a client; returns the ones that were newly subscribed"""
+        worker = self.active_connections.get(websocket)
+        if not worker:
+            return set()
+        added = (set(topics) & set(TOPICS)) - worker.topics
+        worker.topics |= added
+        return added
+    
+    def unsubscribe(self, websocket: WebSocket, topics: Set[str]):
+        worker = self.active_connections.get(websocket)
+        if worker:
+            worker.topics -= set(topics)
+    
+    def send_personal(self, websocket: WebSocket, message: dict):
+        """Queue a message for a single client"""
+        worker = self.active_connections.get(websocket)
+        if worker:
+            worker.enqueue(encode_message(message))
+    
+    async def broadcast(self, topic: str, message: dict):
+        """Publish message to every worker's clients subscribed to topic"""
+        # Encode once; each worker's relay reuses the same text frame
+        await broadcaster.publish(channel=topic_channel(topic), message=encode_message(message))
+    
+    def send_local(self, topic: str, payload: str):
+        """Queue an encoded message for this worker's clients subscribed to topic"""
+        # Never awaits the sockets: memory per client is bounded by its queue size
+        for worker in list(self.active_connections.values()):
+            if topic in worker.topics:
+                worker.enqueue(payload)
+
+    def send_heartbeat(self):
+        """Queue a ping for every client on this worker, whatever its topics"""
+        for worker in list(self.active_connections.values()):
+            worker.enqueue(HEARTBEAT_PAYLOAD)
+
+HEARTBEAT_PAYLOAD = encode_message({"type": "ping"})
 
 manager = ConnectionManager()
 
-# WebSocket endpoint for real-time updates
-@app.websocket("/ws/queue")
-async def websocket_queue_updates(websocket: WebSocket):
+async def send_topic_state(websocket: WebSocket, topic: str, initial: bool = False):
+    """Send the current queue or alerts snapshot to one client"""
+    if topic == "queue":
+        from services.queue_manager import queue_manager
+        # An explicit "refresh" from the client re-reads Firebase; other snapshots use the cache
+        data = await queue_manager.get_queue_statistics(refresh=not initial)
+        message_type = "initial_queue" if initial else "queue_update"
+    else:
+        from services.notification_service import notification_service
+        data = await notification_service.get_active_alerts()
+        message_type = "initial_alerts" if initial else "alerts_update"
+    
+    manager.send_personal(websocket, {
+        "type": message_type,
+        "data": data
+    })
+
+def parse_topics(value) -> Set[str]:
+    """Known topic names from a client's subscribe/unsubscribe value (anything but a list of strings is ignored)"""
+    if not isinstance(value, list):
+        return set()
+    return {topic for topic in value if isinstance(topic, str) and topic in TOPICS}
+
+async def serve_websocket(websocket: WebSocket, topics: Set[str]):
     """
-    WebSocket endpoint for real-time queue updates
-    Sends queue updates to all connected doctors
+    Shared WebSocket loop. Clients may send:
+    - {"subscribe": ["queue", "alerts"]} / {"unsubscribe": [...]} to change topics
+    - "refresh" to get fresh snapshots of every subscribed topic
     """
-    await manager.connect(websocket)
+    await manager.connect(websocket, topics)
     
     try:
-        # Send initial queue state
-        from services.queue_manager import queue_manager
-        initial_queue = await queue_manager.get_queue_statistics()
-        await websocket.send_json({
-            "type": "initial_queue",
-            "data": initial_queue
-        })
+        # Send initial state for the topics the client starts with
+        for topic in topics:
+            await send_topic_state(websocket, topic, initial=True)
         
         # Keep connection alive and listen for messages
         while True:
             try:
-                # Receive any messages from client (heartbeat, etc.)
                 data = await websocket.receive_text()
                 
-                # If client sends "refresh", send updated queue
                 if data == "refresh":
-                    updated_queue = await queue_manager.get_queue_statistics()
-                    await websocket.send_json({
-                        "type": "queue_update",
-                        "data": updated_queue
-                    })
+                    for topic in manager.subscriptions(websocket):
+                        await send_topic_state(websocket, topic)
+                    continue
+                
+                try:
+                    request = orjson.loads(data)
+                except orjson.JSONDecodeError:
+                    continue  # Heartbeats and other plain-text frames
+                if not isinstance(request, dict):
+                    continue
+                
+                added = manager.subscribe(websocket, parse_topics(request.get("subscribe")))
+                for topic in added:
+                    await send_topic_state(websocket, topic, initial=True)
+                manager.unsubscribe(websocket, parse_topics(request.get("unsubscribe")))
             except WebSocketDisconnect:
                 break
             except Exception as e:
@@ -90,54 +206,56 @@ async def websocket_queue_updates(websocket: WebSocket):
     finally:
         manager.disconnect(websocket)
 
+# Multiplexed WebSocket endpoint for real-time updates
+@app.websocket("/ws")
+async def websocket_updates(websocket: WebSocket):
+    """
+    Single WebSocket for queue updates and alerts
+    Clients pick topics with {"subscribe": ["queue", "alerts"]}
+    """
+    await serve_websocket(websocket, set())
+
+@app.websocket("/ws/queue")
+async def websocket_queue_updates(websocket: WebSocket):
+    """
+    WebSocket endpoint for real-time queue updates (pre-subscribed to "queue")
+    """
+    await serve_websocket(websocket, {"queue"})
+
 @app.websocket("/ws/alerts")
 async def websocket_alerts(websocket: WebSocket):
     """
-    WebSocket endpoint for real-time alerts
+    WebSocket endpoint for real-time alerts (pre-subscribed to "alerts")
     """
-    await manager.connect(websocket)
-    
-    try:
-        from services.notification_service import notification_service
-        
-        # Send initial alerts
-        initial_alerts = await notification_service.get_active_alerts()
-        await websocket.send_json({
-            "type": "initial_alerts",
-            "data": initial_alerts
-        })
-        
-        # Keep connection alive
-        while True:
-            try:
-                data = await websocket.receive_text()
-                
-                if data == "refresh":
-                    updated_alerts = await notification_service.get_active_alerts()
-                    await websocket.send_json({
-                        "type": "alerts_update",
-                        "data": updated_alerts
-                    })
-            except WebSocketDisconnect:
-                break
-            except Exception as e:
-                print(f"WebSocket error: {e}")
-                break
-    
-    finally:
-        manager.disconnect(websocket)
+    await serve_websocket(websocket, {"alerts"})
 
-# Background task to check for long-waiting patients
+# Background task to alert on long-waiting patients
 async def check_long_wait_task():
-    """Background task that checks for patients waiting too long"""
+    """Background task that sleeps until the next long-wait deadline fires"""
     from services.queue_manager import queue_manager
     from services.notification_service import notification_service
     
     while True:
         try:
-            await asyncio.sleep(300)  # Check every 5 minutes
+            queue_manager.deadlines_changed.clear()
+            next_deadline = queue_manager.next_wait_deadline()
             
-            long_wait_patients = await queue_manager.check_long_wait_patients()
+            if next_deadline is None:
+                # Nothing queued: sleep until a patient is added
+                await queue_manager.deadlines_changed.wait()
+                continue
+            
+            try:
+                # Wake early if a sooner deadline is scheduled
+                await asyncio.wait_for(
+                    queue_manager.deadlines_changed.wait(),
+                    timeout=max(0, next_deadline - time.time())
+                )
+                continue
+            except asyncio.TimeoutError:
+                pass
+            
+            long_wait_patients = queue_manager.pop_expired_wait_deadlines()
             
             for patient_info in long_wait_patients:
                 entry = patient_info['entry']
@@ -152,18 +270,81 @@ async def check_long_wait_task():
                 )
                 
                 # Broadcast to all connected doctors
-                await manager.broadcast({
+                await manager.broadcast("alerts", {
                     "type": "long_wait_alert",
                     "data": patient_info
                 })
         
+        except Exception:
+            # Back off so a persistent failure (e.g. Firestore down) can't spin the event loop
+            logger.exception("Long wait check error")
+            await asyncio.sleep(5)
+
+# Single timer task pinging every connected client
+async def heartbeat_task():
+    """Ping all local WebSocket clients every WS_HEARTBEAT_INTERVAL seconds"""
+    while True:
+        await asyncio.sleep(settings.WS_HEARTBEAT_INTERVAL)
+        # Local only: every worker runs its own heartbeat for its own sockets
+        manager.send_heartbeat()
+
+# Fallback rebuild of the materialized queue view
+async def refresh_queue_view_task():
+    """Rebuild the active queue view periodically in case a write missed it"""
+    from services.firebase_service import get_firebase_service
+    
+    while True:
+        await asyncio.sleep(settings.QUEUE_VIEW_REFRESH_INTERVAL)
+        try:
+            await get_firebase_service().refresh_queue_view()
         except Exception as e:
-            print(f"Long wait check error: {e}")
+            print(f"Queue view refresh error: {e}")
+
+# Background task relaying published broadcasts to this worker's sockets
+async def relay_broadcasts_task(topic: str):
+    """Forward messages published by any worker to local WebSocket clients"""
+    while True:
+        # Resubscribe after a broker error; every broadcast, even same-process, flows through here
+        try:
+            async with broadcaster.subscribe(channel=topic_channel(topic)) as subscriber:
+                async for event in subscriber:
+                    manager.send_local(topic, event.message)
+        except Exception as e:
+            print(f"Broadcast relay error ({topic}): {e}")
+            await asyncio.sleep(1)
+
+# Long-running tasks started at startup, referenced so they aren't garbage collected
+background_tasks: Set[asyncio.Task] = set()
 
 @app.on_event("startup")
 async def startup_event():
     """Start background tasks on application startup"""
-    asyncio.create_task(check_long_wait_task())
+    from services.queue_manager import queue_manager
+    
+    # Size the default executor used by asyncio.to_thread (FCM sends etc.)
+    asyncio.get_running_loop().set_default_executor(
+        ThreadPoolExecutor(max_workers=(os.cpu_count() or 1) * 2)
+    )
+    await broadcaster.connect()
+    for topic in TOPICS:
+        background_tasks.add(asyncio.create_task(relay_broadcasts_task(topic)))
+    background_tasks.add(asyncio.create_task(check_long_wait_task()))
+    background_tasks.add(asyncio.create_task(heartbeat_task()))
+    background_tasks.add(asyncio.create_task(refresh_queue_view_task()))
+    background_tasks.add(asyncio.create_task(queue_manager.reconcile_loop()))
+    
+    # Every local queue mutation asks for a snapshot broadcast; bursts share one
+    queue_manager.change_listener = queue_update_debouncer.schedule
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    """Release shared connections on application shutdown"""
+    from services.real_ai_service import real_ai_engine
+    from utils.process_pool import shutdown_process_pool
+    
+    await broadcaster.disconnect()
+    await real_ai_engine.close()
+    shutdown_process_pool()
 
 @app.get("/")
 async def root():
@@ -186,18 +367,53 @@ async def health_check():
 # Broadcast helper function (can be called from other modules)
 async def broadcast_queue_update(queue_data: dict):
     """Helper function to broadcast queue updates"""
-    await manager.broadcast({
+    await manager.broadcast("queue", {
         "type": "queue_update",
         "data": queue_data
     })
 
+# Coalesces bursts of calls into one call once the window closes
+class Debouncer:
+    def __init__(self, fn: Callable[[], Awaitable[None]], delay: float = 0.1):
+        self._fn = fn
+        self._delay = delay
+        self._handle: Optional[asyncio.TimerHandle] = None
+        self._task: Optional[asyncio.Task] = None
+    
+    def schedule(self):
+        """Run fn once the debounce window closes (no-op if a run is already scheduled)"""
+        if self._handle is None:
+            self._handle = asyncio.get_running_loop().call_later(self._delay, self._flush)
+    
+    def _flush(self):
+        if self._task is not None and not self._task.done():
+            # Previous run still going: try again after another window so runs never overlap
+            self._handle = asyncio.get_running_loop().call_later(self._delay, self._flush)
+            return
+        self._handle = None
+        self._task = asyncio.create_task(self._run())
+    
+    async def _run(self):
+        try:
+            await self._fn()
+        except Exception:
+            logger.exception("Debounced call failed")
+
+async def publish_queue_snapshot():
+    """Broadcast the current local queue statistics"""
+    from services.queue_manager import queue_manager
+    await broadcast_queue_update(await queue_manager.get_queue_statistics())
+
+queue_update_debouncer = Debouncer(publish_queue_snapshot, delay=0.1)
+
 async def broadcast_alert(alert_data: dict):
     """Helper function to broadcast new alerts"""
-    await manager.broadcast({
+    await manager.broadcast("alerts", {
         "type": "new_alert",
         "data": alert_data
     })
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
+    # uvloop/httptools ship with uvicorn[standard]
+    uvicorn.run(app, host="0.0.0.0", port=8000, loop="uvloop", http="httptools", ws="websockets")
\ No newline at end of file
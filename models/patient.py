@@ -1,7 +1,12 @@
-from pydantic import BaseModel, EmailStr, Field
+from pydantic import BaseModel, EmailStr, Field, field_validator
 from typing import Optional, List
 from datetime import datetime
 from enum import Enum
+import re
+from config import settings
+
+# E.164 phone number, compiled once at import
+_PHONE_RE = re.compile(r'^\+?[1-9]\d{1,14}$')
 
 class Gender(str, Enum):
     MALE = "male"
@@ -23,7 +28,7 @@ class PatientBase(BaseModel):
     first_name: str = Field(..., min_length=1, max_length=100)
     last_name: str = Field(..., min_length=1, max_length=100)
     email: Optional[EmailStr] = None
-    phone: str = Field(..., pattern=r'^\+?[1-9]\d{1,14}$')
+    phone: str
     date_of_birth: str
     gender: Gender
     blood_type: Optional[BloodType] = BloodType.UNKNOWN
@@ -33,6 +38,13 @@ class PatientBase(BaseModel):
     allergies: Optional[List[str]] = []
     current_medications: Optional[List[str]] = []
 
+    @field_validator('phone')
+    @classmethod
+    def validate_phone(cls, value: str) -> str:
+        if not _PHONE_RE.fullmatch(value):
+            raise ValueError('Phone number must be in E.164 format, e.g. +15551234567')
+        return value
+
 class PatientCreate(PatientBase):
     pass
 
@@ -62,7 +74,7 @@ class VitalsResponse(VitalsBase):
     abnormal_flags: List[str] = []
 
 class SymptomInput(BaseModel):
-    symptom_text: str = Field(..., min_length=10, max_length=2000, description="Patient's symptom description")
+    symptom_text: str = Field(..., min_length=10, max_length=settings.MAX_SYMPTOM_TEXT_LENGTH, description="Patient's symptom description")
     duration: Optional[str] = None
     severity_self_reported: Optional[int] = Field(None, ge=1, le=10)
     additional_notes: Optional[str] = None
@@ -84,4 +96,8 @@ class VisitResponse(BaseModel):
     assigned_doctor_id: Optional[str] = None
     consultation_notes: Optional[str] = None
     created_at: datetime
-    updated_at: Optional[datetime] = None
\ No newline at end of file
+    updated_at: Optional[datetime] = None
+
+# Resolve any deferred validator schemas at import, not on the first request
+for _model in (PatientResponse, VitalsResponse, VisitResponse):
+    _model.model_rebuild()
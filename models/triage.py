@@ -1,7 +1,14 @@
 from pydantic import BaseModel, Field
 from typing import Optional, List, Dict
-from datetime import datetime
+from datetime import datetime, timezone
 from enum import Enum
+from time import time
+from config import settings
+from models.patient import SymptomInput, VitalsBase
+
+def _utcnow() -> datetime:
+    """Timezone-aware UTC timestamp for model defaults"""
+    return datetime.fromtimestamp(time(), tz=timezone.utc)
 
 class SeverityLevel(str, Enum):
     NORMAL = "normal"
@@ -21,7 +28,7 @@ class TriageResult(BaseModel):
     rule_based_override: bool = False
     recommendation: str
     estimated_wait_time: Optional[int] = None  # in minutes
-    created_at: datetime = Field(default_factory=datetime.utcnow)
+    created_at: datetime = Field(default_factory=_utcnow)
 
 class QueueEntry(BaseModel):
     id: str
@@ -57,7 +64,7 @@ class Alert(BaseModel):
     patient_name: str
     visit_id: str
     data: Dict = {}
-    created_at: datetime = Field(default_factory=datetime.utcnow)
+    created_at: datetime = Field(default_factory=_utcnow)
     acknowledged: bool = False
     acknowledged_by: Optional[str] = None
     acknowledged_at: Optional[datetime] = None
@@ -80,11 +87,22 @@ class DoctorNote(BaseModel):
     follow_up_required: bool = False
     follow_up_date: Optional[datetime] = None
     notes: Optional[str] = None
-    created_at: datetime = Field(default_factory=datetime.utcnow)
+    created_at: datetime = Field(default_factory=_utcnow)
 
 class FollowUpCreate(BaseModel):
     visit_id: str
     patient_id: str
-    symptoms_update: str
+    symptoms_update: str = Field(..., max_length=settings.MAX_SYMPTOM_TEXT_LENGTH)
     condition_change: str  # "improved", "same", "worsened"
-    new_vitals: Optional[Dict] = None
\ No newline at end of file
+    new_vitals: Optional[Dict] = None
+
+class TriageBatchItem(BaseModel):
+    symptoms: SymptomInput
+    vitals: VitalsBase
+
+class TriageBatchRequest(BaseModel):
+    items: List[TriageBatchItem] = Field(..., min_length=1, max_length=100)
+
+# Resolve any deferred validator schemas at import, not on the first request
+for _model in (TriageResult, QueueEntry, Alert, DoctorNote, TriageBatchRequest):
+    _model.model_rebuild()
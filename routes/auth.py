@@ -2,11 +2,29 @@ from fastapi import APIRouter, HTTPException, Body
 from pydantic import BaseModel, EmailStr
 from typing import Optional
 from utils.security import hash_password, verify_password, create_access_token
-from services.firebase_service import firebase_service
+from services.firebase_service import get_firebase_service
+from google.api_core.exceptions import AlreadyExists
 from datetime import timedelta
+import hashlib
 
 router = APIRouter(prefix="/auth", tags=["Authentication"])
 
+def _normalize_email(email: str) -> str:
+    return email.strip().lower()
+
+def _email_key(email: str) -> str:
+    """Deterministic user document ID derived from the normalized email"""
+    return hashlib.sha256(_normalize_email(email).encode()).hexdigest()
+
+async def _find_legacy_user(collection: str, email: str):
+    """Look up an account stored under an auto-generated ID (created before email keys)"""
+    # Legacy records keep the email as typed at signup; try it as given and normalized
+    variants = list(dict.fromkeys([email, _normalize_email(email)]))
+    users = get_firebase_service().db.collection(collection).where('email', 'in', variants).limit(1).stream()
+    async for snapshot in users:
+        return snapshot
+    return None
+
 class UserRegister(BaseModel):
     email: EmailStr
     password: str
@@ -33,15 +51,15 @@ class DeviceTokenRegister(BaseModel):
 async def register(user: UserRegister):
     """Register a new user (doctor or patient)"""
     
-    # Check if user already exists
     collection = "doctors" if user.user_type == "doctor" else "patients"
-    existing_users = firebase_service.db.collection(collection).where('email', '==', user.email).limit(1).stream()
+    doc_ref = get_firebase_service().db.collection(collection).document(_email_key(user.email))
     
-    for _ in existing_users:
+    # Reject known emails before paying for the hash (create() below still guards races)
+    if (await doc_ref.get()).exists:
         raise HTTPException(status_code=400, detail="User with this email already exists")
     
-    # Hash password
-    hashed_password = hash_password(user.password)
+    # Hash password in the shared process pool (bcrypt is deliberately CPU-bound)
+    hashed_password = await hash_password(user.password)
     
     # Prepare user data
     user_data = {
@@ -58,9 +76,11 @@ async def register(user: UserRegister):
         user_data['license_number'] = user.license_number
         user_data['verified'] = False  # Require verification
     
-    # Save to Firebase
-    doc_ref = firebase_service.db.collection(collection).document()
-    doc_ref.set(user_data)
+    # Save to Firebase under the email-derived ID; create() fails if the user already exists
+    try:
+        await doc_ref.create(user_data)
+    except AlreadyExists:
+        raise HTTPException(status_code=400, detail="User with this email already exists")
     user_id = doc_ref.id
     
     # Create access token
@@ -90,21 +110,32 @@ async def login(credentials: UserLogin):
     
     collection = "doctors" if credentials.user_type == "doctor" else "patients"
     
-    # Find user by email
-    users = firebase_service.db.collection(collection).where('email', '==', credentials.email).limit(1).stream()
-    
-    user_doc = None
-    user_id = None
-    for doc in users:
-        user_doc = doc.to_dict()
-        user_id = doc.id
-        break
-    
-    if not user_doc:
+    # Find user by email-derived document ID (single key read, no query)
+    users = get_firebase_service().db.collection(collection)
+    key_ref = users.document(_email_key(credentials.email))
+    snapshot = await key_ref.get()
+    
+    if snapshot.exists and 'legacy_id' in snapshot.to_dict():
+        # Re-keyed account from before email keys: the key document points at the original
+        snapshot = await users.document(snapshot.to_dict()['legacy_id']).get()
+    elif not snapshot.exists:
+        # First login of an account stored under an auto ID: find it once, then re-key it
+        snapshot = await _find_legacy_user(collection, credentials.email)
+        if snapshot is not None:
+            try:
+                await key_ref.create({'legacy_id': snapshot.id})
+            except AlreadyExists:
+                pass  # A concurrent login re-keyed it first
+    
+    if snapshot is None or not snapshot.exists:
         raise HTTPException(status_code=401, detail="Invalid email or password")
     
-    # Verify password
-    if not verify_password(credentials.password, user_doc['password']):
+    user_doc = snapshot.to_dict()
+    user_id = snapshot.id
+    
+    # Verify password in the shared process pool (bcrypt is deliberately CPU-bound)
+    password_ok = await verify_password(credentials.password, user_doc['password'])
+    if not password_ok:
         raise HTTPException(status_code=401, detail="Invalid email or password")
     
     # Check if doctor is verified
@@ -140,7 +171,7 @@ async def register_device_token(
 ):
     """Register device token for push notifications"""
     
-    success = await firebase_service.register_device_token(
+    success = await get_firebase_service().register_device_token(
         user_id,
         device_token_data.device_token,
         user_type
@@ -1,7 +1,9 @@
-from fastapi import APIRouter, Depends, HTTPException
-from typing import List, Dict
+from fastapi import APIRouter, Depends, HTTPException, Query
+from typing import List, Dict, Optional
+from datetime import datetime
+import asyncio
 from models.triage import DoctorNote
-from services.firebase_service import firebase_service
+from services.firebase_service import get_firebase_service
 from services.queue_manager import queue_manager
 from services.notification_service import notification_service
 from utils.security import get_current_user, require_doctor
@@ -9,10 +11,23 @@ from utils.security import get_current_user, require_doctor
 router = APIRouter(prefix="/doctor", tags=["Doctor"])
 
 @router.get("/queue")
-async def get_queue(current_user: dict = Depends(require_doctor)):
-    """Get current triage queue"""
+async def get_queue(
+    limit: Optional[int] = Query(None, ge=1, le=200),
+    offset: int = Query(0, ge=0),
+    current_user: dict = Depends(require_doctor)
+):
+    """Get current triage queue (pass limit/offset to page through the entries)"""
     
     queue_stats = await queue_manager.get_queue_statistics()
+    
+    if limit is not None:
+        queue = queue_stats['queue']
+        queue_stats = {
+            **queue_stats,
+            'queue': queue[offset:offset + limit],
+            'next_offset': offset + limit if offset + limit < len(queue) else None
+        }
+    
     return queue_stats
 
 @router.post("/call-patient/{visit_id}")
@@ -45,10 +60,10 @@ async def save_consultation_notes(note: DoctorNote, current_user: dict = Depends
     note_data['doctor_id'] = current_user['id']
     note_data['doctor_name'] = current_user['name']
     
-    note_id = await firebase_service.save_doctor_note(note_data)
+    note_id = await get_firebase_service().save_doctor_note(note_data)
     
     # Update visit status
-    await firebase_service.update_visit(note.visit_id, {
+    await get_firebase_service().update_visit(note.visit_id, {
         'status': 'completed',
         'doctor_note_id': note_id
     })
@@ -65,7 +80,7 @@ async def save_consultation_notes(note: DoctorNote, current_user: dict = Depends
 async def get_consultation_notes(visit_id: str, current_user: dict = Depends(require_doctor)):
     """Get consultation notes for a visit"""
     
-    notes = await firebase_service.get_visit_notes(visit_id)
+    notes = await get_firebase_service().get_visit_notes(visit_id)
     
     if not notes:
         raise HTTPException(status_code=404, detail="Notes not found")
@@ -73,11 +88,30 @@ async def get_consultation_notes(visit_id: str, current_user: dict = Depends(req
     return notes
 
 @router.get("/alerts")
-async def get_active_alerts(current_user: dict = Depends(require_doctor)):
-    """Get all active alerts"""
+async def get_active_alerts(
+    limit: Optional[int] = Query(None, ge=1, le=200),
+    cursor: Optional[str] = None,
+    current_user: dict = Depends(require_doctor)
+):
+    """
+    Get all active alerts
+    With limit, returns one page and a next_cursor to pass back for the next one
+    """
+    
+    if limit is None:
+        return await notification_service.get_active_alerts()
+    
+    try:
+        after = datetime.fromisoformat(cursor) if cursor else None
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    
+    alerts = await notification_service.get_active_alerts(limit=limit, cursor=after)
     
-    alerts = await notification_service.get_active_alerts()
-    return alerts
+    return {
+        "items": alerts,
+        "next_cursor": alerts[-1]['created_at'].isoformat() if len(alerts) == limit else None
+    }
 
 @router.post("/alerts/{alert_id}/acknowledge")
 async def acknowledge_alert(alert_id: str, current_user: dict = Depends(require_doctor)):
@@ -94,12 +128,14 @@ async def acknowledge_alert(alert_id: str, current_user: dict = Depends(require_
 async def get_patient_details(patient_id: str, current_user: dict = Depends(require_doctor)):
     """Get complete patient details including history"""
     
-    patient = await firebase_service.get_patient(patient_id)
+    # Both reads are independent, so issue them concurrently
+    patient, visits = await asyncio.gather(
+        get_firebase_service().get_patient(patient_id),
+        get_firebase_service().get_patient_visits(patient_id)
+    )
     if not patient:
         raise HTTPException(status_code=404, detail="Patient not found")
     
-    visits = await firebase_service.get_patient_visits(patient_id)
-    
     return {
         "patient": patient,
         "visits": visits,
@@ -110,10 +146,12 @@ async def get_patient_details(patient_id: str, current_user: dict = Depends(requ
 async def get_doctor_statistics(current_user: dict = Depends(require_doctor)):
     """Get doctor dashboard statistics"""
     
-    queue_stats = await queue_manager.get_queue_statistics()
-    alerts = await notification_service.get_active_alerts()
+    queue_stats, alerts = await asyncio.gather(
+        queue_manager.get_queue_statistics(),
+        notification_service.get_active_alerts()
+    )
     
-    # Check for long wait patients
+    # Check for long wait patients (reads the same cached queue)
     long_wait = await queue_manager.check_long_wait_patients()
     
     return {
@@ -1,31 +1,41 @@
 from fastapi import APIRouter, Depends, HTTPException
-from typing import List
+from pydantic import BaseModel
+from typing import Dict, List, Type
 from models.patient import PatientCreate, PatientResponse, VisitCreate, VisitResponse
-from services.firebase_service import firebase_service
+from services.firebase_service import get_firebase_service
 from utils.security import get_current_user
 
 router = APIRouter(prefix="/patients", tags=["Patients"])
 
+# Stored visit fields the visit history response needs ('id' is the document id)
+_VISIT_FIELDS = [key for key in VisitResponse.model_fields if key != 'id']
+
+def _project(data: Dict, model: Type[BaseModel]) -> Dict:
+    """Keep only the fields a response model exposes (drops e.g. password hashes)"""
+    return {key: data[key] for key in model.model_fields if key in data}
+
 @router.post("/", response_model=PatientResponse)
 async def create_patient(patient: PatientCreate, current_user: dict = Depends(get_current_user)):
     """Create a new patient record"""
     
     patient_data = patient.model_dump()
-    patient_id = await firebase_service.create_patient(patient_data)
+    patient_id = await get_firebase_service().create_patient(patient_data)
     
-    created_patient = await firebase_service.get_patient(patient_id)
+    created_patient = await get_firebase_service().get_patient(patient_id)
     return created_patient
 
-@router.get("/{patient_id}", response_model=PatientResponse)
+# Hot read paths: Firestore data is trusted, so project fields instead of
+# re-validating through pydantic; responses= keeps the schema in the docs
+@router.get("/{patient_id}", response_model=None, responses={200: {"model": PatientResponse}})
 async def get_patient(patient_id: str, current_user: dict = Depends(get_current_user)):
     """Get patient by ID"""
     
-    patient = await firebase_service.get_patient(patient_id)
+    patient = await get_firebase_service().get_patient(patient_id)
     
     if not patient:
         raise HTTPException(status_code=404, detail="Patient not found")
     
-    return patient
+    return _project(patient, PatientResponse)
 
 @router.put("/{patient_id}")
 async def update_patient(
@@ -35,16 +45,16 @@ async def update_patient(
 ):
     """Update patient information"""
     
-    success = await firebase_service.update_patient(patient_id, updates)
+    success = await get_firebase_service().update_patient(patient_id, updates)
     
     if success:
         return {"message": "Patient updated successfully"}
     else:
         raise HTTPException(status_code=500, detail="Failed to update patient")
 
-@router.get("/{patient_id}/visits", response_model=List[VisitResponse])
+@router.get("/{patient_id}/visits", response_model=None, responses={200: {"model": List[VisitResponse]}})
 async def get_patient_visits(patient_id: str, current_user: dict = Depends(get_current_user)):
     """Get all visits for a patient"""
     
-    visits = await firebase_service.get_patient_visits(patient_id)
-    return visits
\ No newline at end of file
+    visits = await get_firebase_service().get_patient_visits(patient_id, fields=_VISIT_FIELDS)
+    return [_project(visit, VisitResponse) for visit in visits]
\ No newline at end of file
@@ -1,59 +1,76 @@
-from fastapi import APIRouter, Depends, HTTPException
-from typing import Dict
+from fastapi import APIRouter, BackgroundTasks, Depends, HTTPException
 from datetime import datetime
+from functools import lru_cache
 from models.patient import VisitCreate
-from models.triage import TriageResult, FollowUpCreate
-from services.firebase_service import firebase_service
+from models.triage import TriageResult, FollowUpCreate, TriageBatchRequest
+from services.firebase_service import get_firebase_service
 from services.real_ai_service import real_ai_engine  # NEW: Real AI service
 from services.queue_manager import queue_manager
 from services.notification_service import notification_service
 from utils.security import get_current_user
 from config import settings
+import asyncio
+
+# Rule-based engine (spaCy) is optional; it's only needed for the fallback and batch paths
+try:
+    from services.ai_engine import predict_severity_async, predict_severity_batch_async, reassess_severity_async
+except ImportError:
+    predict_severity_async = predict_severity_batch_async = reassess_severity_async = None
 
 router = APIRouter(prefix="/triage", tags=["Triage"])
 
-@router.post("/assess", response_model=Dict)
-async def assess_patient(visit: VisitCreate, current_user: dict = Depends(get_current_user)):
+@router.post("/assess")
+async def assess_patient(
+    visit: VisitCreate,
+    background_tasks: BackgroundTasks,
+    current_user: dict = Depends(get_current_user)
+):
     """
     Complete triage assessment workflow with REAL AI:
     1. Create visit record
     2. Run REAL AI analysis (OpenAI/Claude)
     3. Add to priority queue
-    4. Send notifications if critical
+    4. Send notifications if critical (in the background)
     """
     
-    # Step 1: Create visit record
+    # Step 1: Create visit record (vitals dumped once; recorded-only view reused below)
+    vitals_all = visit.vitals.model_dump()
+    vitals_recorded = {k: v for k, v in vitals_all.items() if v is not None}
+    
     visit_data = {
         'patient_id': visit.patient_id,
         'chief_complaint': visit.chief_complaint,
         'symptoms': visit.symptoms.model_dump(),
-        'vitals': visit.vitals.model_dump()
+        'vitals': vitals_all
     }
     
-    visit_id = await firebase_service.create_visit(visit_data)
-    
-    # Step 2: Get patient info
-    patient = await firebase_service.get_patient(visit.patient_id)
+    # Step 2: Get patient info (concurrently with the visit write)
+    visit_id, patient = await asyncio.gather(
+        get_firebase_service().create_visit(visit_data),
+        get_firebase_service().get_patient(visit.patient_id)
+    )
     if not patient:
         raise HTTPException(status_code=404, detail="Patient not found")
     
+    # Patient age, shared by the AI prompt and the queue entry
+    age = calculate_age(patient['date_of_birth'])
+    
     # Step 3: Run REAL AI triage assessment
     try:
         triage_result = await real_ai_engine.comprehensive_assessment(
             symptom_text=visit.symptoms.symptom_text,
-            vitals=visit.vitals.model_dump(exclude_none=True),
-            age=calculate_age(patient['date_of_birth']),
+            vitals=vitals_recorded,
+            age=age,
             pain_level=visit.symptoms.severity_self_reported or 5,
             duration=visit.symptoms.duration or "",
             comorbidities=patient.get('medical_history', [])
         )
     except Exception as e:
         # If AI fails and fallback is enabled, use rule-based system
-        if settings.USE_FALLBACK_AI:
-            from services.ai_engine import ai_engine
-            triage_result = ai_engine.predict_severity(
+        if settings.USE_FALLBACK_AI and predict_severity_async:
+            triage_result = await predict_severity_async(
                 symptom_text=visit.symptoms.symptom_text,
-                vitals=visit.vitals.model_dump(exclude_none=True),
+                vitals=vitals_recorded,
                 duration=visit.symptoms.duration
             )
             triage_result['aiPowered'] = False
@@ -68,21 +85,7 @@ async def assess_patient(visit: VisitCreate, current_user: dict = Depends(get_cu
         **triage_result
     }
     
-    triage_id = await firebase_service.save_triage_result(triage_data)
-    
-    # Step 5: Update visit with triage results
-    await firebase_service.update_visit(visit_id, {
-        'triage_score': triage_result['score'],
-        'severity_level': triage_result['level'],
-        'triage_result_id': triage_id,
-        'ai_powered': triage_result.get('aiPowered', False),
-        'ai_provider': triage_result.get('aiProvider', 'unknown')
-    })
-    
-    # Step 6: Calculate patient age for queue entry
-    age = calculate_age(patient['date_of_birth'])
-    
-    # Step 7: Add to priority queue
+    # Step 5: Build priority queue entry
     queue_entry = {
         'visit_id': visit_id,
         'patient_id': visit.patient_id,
@@ -93,7 +96,7 @@ async def assess_patient(visit: VisitCreate, current_user: dict = Depends(get_cu
         'priority': triage_result['priority'],
         'chief_complaint': visit.chief_complaint,
         'symptoms_summary': visit.symptoms.symptom_text[:200],
-        'vital_signs': visit.vitals.model_dump(exclude_none=True),
+        'vital_signs': vitals_recorded,
         'emergency_flags': triage_result.get('emergencyFlags', []),
         'differential_diagnosis': triage_result.get('differential', []),
         'clinical_concerns': triage_result.get('clinicalConcerns', []),
@@ -101,11 +104,25 @@ async def assess_patient(visit: VisitCreate, current_user: dict = Depends(get_cu
         'queue_position': 0  # Will be calculated by queue manager
     }
     
-    queue_result = await queue_manager.add_to_queue(queue_entry)
+    # Step 6: Save triage result and add to queue concurrently
+    triage_id, queue_result = await asyncio.gather(
+        get_firebase_service().save_triage_result(triage_data),
+        queue_manager.add_to_queue(queue_entry)
+    )
+    
+    # Update visit with triage results (needs the triage result id)
+    await get_firebase_service().update_visit(visit_id, {
+        'triage_score': triage_result['score'],
+        'severity_level': triage_result['level'],
+        'triage_result_id': triage_id,
+        'ai_powered': triage_result.get('aiPowered', False),
+        'ai_provider': triage_result.get('aiProvider', 'unknown')
+    })
     
-    # Step 8: Send notifications if critical
+    # Step 7: Send notifications if critical (after the response is sent)
     if triage_result['level'] == 'critical':
-        await notification_service.notify_severity_change(
+        background_tasks.add_task(
+            notification_service.notify_severity_change,
             patient_id=visit.patient_id,
             patient_name=queue_entry['patient_name'],
             visit_id=visit_id,
@@ -114,9 +131,10 @@ async def assess_patient(visit: VisitCreate, current_user: dict = Depends(get_cu
             severity_score=triage_result['score']
         )
     
-    # Step 9: Check for vital abnormalities
+    # Step 8: Check for vital abnormalities
     if triage_result.get('vitalFlags'):
-        await notification_service.notify_vital_deterioration(
+        background_tasks.add_task(
+            notification_service.notify_vital_deterioration,
             patient_id=visit.patient_id,
             patient_name=queue_entry['patient_name'],
             visit_id=visit_id,
@@ -132,6 +150,29 @@ async def assess_patient(visit: VisitCreate, current_user: dict = Depends(get_cu
         'ai_provider': triage_result.get('aiProvider', 'unknown')
     }
 
+@router.post("/assess-batch")
+async def assess_batch(batch: TriageBatchRequest, current_user: dict = Depends(get_current_user)):
+    """
+    Rule-based severity scoring for a batch of symptom/vitals pairs
+    Nothing is stored; use /assess to create visits and queue entries
+    """
+    if predict_severity_batch_async is None:
+        raise HTTPException(status_code=503, detail="Rule-based triage engine is not installed")
+    
+    results = await predict_severity_batch_async([
+        {
+            'symptom_text': item.symptoms.symptom_text,
+            'vitals': item.vitals.model_dump(exclude_none=True),
+            'duration': item.symptoms.duration
+        }
+        for item in batch.items
+    ])
+    
+    return {
+        'count': len(results),
+        'results': results
+    }
+
 @router.post("/follow-up")
 async def follow_up_assessment(
     follow_up: FollowUpCreate,
@@ -142,14 +183,14 @@ async def follow_up_assessment(
     """
     
     # Get original visit
-    visit = await firebase_service.get_visit(follow_up.visit_id)
+    visit = await get_firebase_service().get_visit(follow_up.visit_id)
     if not visit:
         raise HTTPException(status_code=404, detail="Visit not found")
     
     original_score = visit.get('triage_score', 0)
     
     # Get patient info
-    patient = await firebase_service.get_patient(follow_up.patient_id)
+    patient = await get_firebase_service().get_patient(follow_up.patient_id)
     
     # Reassess with AI
     try:
@@ -165,9 +206,8 @@ async def follow_up_assessment(
             comorbidities=patient.get('medical_history', [])
         )
     except Exception as e:
-        if settings.USE_FALLBACK_AI:
-            from services.ai_engine import ai_engine
-            reassessment = ai_engine.reassess_severity(
+        if settings.USE_FALLBACK_AI and reassess_severity_async:
+            reassessment = await reassess_severity_async(
                 original_score=original_score,
                 follow_up_text=follow_up.symptoms_update,
                 condition_change=follow_up.condition_change
@@ -179,7 +219,7 @@ async def follow_up_assessment(
     new_severity = reassessment['level']
     
     # Update visit
-    await firebase_service.update_visit(follow_up.visit_id, {
+    await get_firebase_service().update_visit(follow_up.visit_id, {
         'triage_score': new_score,
         'severity_level': new_severity,
         'follow_up_note': follow_up.symptoms_update,
@@ -227,20 +267,24 @@ async def follow_up_assessment(
 async def get_triage_result(visit_id: str, current_user: dict = Depends(get_current_user)):
     """Get triage result for a visit"""
     
-    visit = await firebase_service.get_visit(visit_id)
+    visit = await get_firebase_service().get_visit(visit_id)
     if not visit:
         raise HTTPException(status_code=404, detail="Visit not found")
     
     return visit
 
+@lru_cache(maxsize=4096)
+def _parse_date_of_birth(date_of_birth: str) -> datetime:
+    """Parse an ISO date of birth once per distinct string"""
+    return datetime.fromisoformat(date_of_birth.replace('Z', '+00:00'))
+
 def calculate_age(date_of_birth) -> int:
     """Helper function to calculate age"""
-    from datetime import datetime
     if isinstance(date_of_birth, str):
-        dob = datetime.fromisoformat(date_of_birth.replace('Z', '+00:00'))
+        dob = _parse_date_of_birth(date_of_birth)
     else:
         dob = date_of_birth
     
     today = datetime.utcnow()
     age = today.year - dob.year - ((today.month, today.day) < (dob.month, dob.day))
-    return age
\ No newline at end of file
+    return age
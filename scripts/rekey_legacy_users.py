@@ -0,0 +1,38 @@
+"""
+One-off migration: give every account stored under an auto-generated ID its
+email-derived key document, so register() rejects re-registration of that
+email and login() never needs the email query for it.
+
+Run once from the project root: python -m scripts.rekey_legacy_users
+"""
+
+import asyncio
+from google.api_core.exceptions import AlreadyExists
+from routes.auth import _email_key
+from services.firebase_service import get_firebase_service
+
+async def rekey_collection(collection: str):
+    """Create {'legacy_id': ...} key documents for one user collection"""
+    users = get_firebase_service().db.collection(collection)
+    created = conflicts = 0
+    
+    async for doc in users.stream():
+        data = doc.to_dict()
+        if 'legacy_id' in data or not data.get('email') or doc.id == _email_key(data['email']):
+            continue  # Key document or an account already stored under its key
+        
+        try:
+            await users.document(_email_key(data['email'])).create({'legacy_id': doc.id})
+            created += 1
+        except AlreadyExists:
+            conflicts += 1
+            print(f"⚠️ {collection}/{doc.id}: another account already holds the key for {data['email']}")
+    
+    print(f"✅ {collection}: {created} re-keyed, {conflicts} conflicts")
+
+async def main():
+    for collection in ("patients", "doctors"):
+        await rekey_collection(collection)
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -1,22 +1,34 @@
 import spacy
 import re
-from typing import Dict, List, Tuple
-import numpy as np
-from sklearn.feature_extraction.text import TfidfVectorizer
-from sklearn.ensemble import RandomForestClassifier
-import pickle
+from typing import Dict, List, Optional, Tuple
 import os
-from config import settings
+import asyncio
+from bisect import bisect_right
+from cachetools import LRUCache
+from config import settings, EMERGENCY_KEYWORD_PATTERN
+from utils.process_pool import get_process_pool
+
+# Fixed fields of the emergency-override result, merged into each response
+_EMERGENCY_TEMPLATE = {
+    'severity_score': 100,
+    'severity_level': 'critical',
+    'priority': 1,
+    'rule_based_override': True,
+    'recommendation': "IMMEDIATE EMERGENCY CARE REQUIRED"
+}
+
+# Score cutoffs and the (level, priority, recommendation) band each range maps to
+_SEVERITY_CUTOFFS = (settings.MODERATE_MIN, settings.CRITICAL_MIN)
+_SEVERITY_BANDS = (
+    ('normal', 3, "Standard consultation. Can wait for available slot."),
+    ('moderate', 2, "Medical evaluation needed soon. Moderate priority."),
+    ('critical', 1, "Immediate medical attention required. Priority patient.")
+)
 
 class AITriageEngine:
     def __init__(self):
-        # Load SpaCy model for NLP
-        try:
-            self.nlp = spacy.load(settings.NLP_MODEL)
-        except:
-            print("Downloading SpaCy model...")
-            os.system(f"python -m spacy download {settings.NLP_MODEL}")
-            self.nlp = spacy.load(settings.NLP_MODEL)
+        # SpaCy model is loaded on first use (see the nlp property)
+        self._nlp = None
         
         # Emergency keywords for rule-based overrides
         self.emergency_keywords = settings.EMERGENCY_KEYWORDS
@@ -42,6 +54,15 @@ class AITriageEngine:
             'mild nausea': 25, 'minor pain': 20, 'bruise': 15
         }
         
+        # All known symptoms compiled into one alternation (longest first so
+        # 'severe head injury' wins over shorter overlapping phrases), one
+        # capture group per symptom so match.lastindex indexes its severity
+        self._symptom_names = tuple(sorted(self.symptom_severity_map, key=len, reverse=True))
+        self._symptom_severities = tuple(self.symptom_severity_map[s] for s in self._symptom_names)
+        self._symptom_re = re.compile(
+            "|".join(f"({re.escape(s)})" for s in self._symptom_names)
+        )
+        
         # Vital signs thresholds for abnormality detection
         self.vital_thresholds = {
             'temperature': {'critical_low': 35.5, 'low': 36.0, 'high': 38.0, 'critical_high': 39.5},
@@ -51,39 +72,52 @@ class AITriageEngine:
             'respiratory_rate': {'critical_low': 10, 'low': 12, 'high': 20, 'critical_high': 30},
             'oxygen_saturation': {'critical_low': 90, 'low': 95, 'high': 100, 'critical_high': 100}
         }
+        
+        # Same thresholds flattened to (name, critical_low, low, high, critical_high) rows
+        self._vital_bounds = tuple(
+            (name, t['critical_low'], t['low'], t['high'], t['critical_high'])
+            for name, t in self.vital_thresholds.items()
+        )
     
-    def extract_symptoms(self, text: str) -> List[str]:
-        """Extract symptoms from text using NLP"""
-        doc = self.nlp(text.lower())
+    def classify_score(self, score: int) -> Tuple[str, int, str]:
+        """Map a 0-100 score to (severity_level, priority, recommendation)"""
+        return _SEVERITY_BANDS[bisect_right(_SEVERITY_CUTOFFS, score)]
+    
+    @property
+    def nlp(self):
+        """SpaCy pipeline, loaded the first time free text needs parsing"""
+        if self._nlp is None:
+            # Only what noun_chunks needs (tagger + parser); excluded components are never read from disk
+            nlp_exclude = ["ner", "lemmatizer"]
+            try:
+                self._nlp = spacy.load(settings.NLP_MODEL, exclude=nlp_exclude)
+            except OSError:
+                print("Downloading SpaCy model...")
+                os.system(f"python -m spacy download {settings.NLP_MODEL}")
+                self._nlp = spacy.load(settings.NLP_MODEL, exclude=nlp_exclude)
+        return self._nlp
+    
+    def extract_symptoms(self, text: str, doc=None) -> List[str]:
+        """Extract symptoms from lowercased text using NLP (doc: text already parsed by nlp.pipe)"""
+        # Fast path: known symptoms found by keyword scan, no need to parse
+        symptoms = [match.group() for match in self._symptom_re.finditer(text)]
+        if symptoms:
+            return list(dict.fromkeys(symptoms))  # Remove duplicates, keep order of mention
         
-        symptoms = []
+        if doc is None:
+            doc = self.nlp(text)
         
-        # Extract noun phrases and named entities
+        # Extract noun phrases
         for chunk in doc.noun_chunks:
             if len(chunk.text.split()) <= 4:  # Limit phrase length
                 symptoms.append(chunk.text)
         
-        # Extract medical entities if available
-        for ent in doc.ents:
-            if ent.label_ in ['SYMPTOM', 'DISEASE', 'CONDITION']:
-                symptoms.append(ent.text)
-        
-        # Match against known symptoms
-        for symptom in self.symptom_severity_map.keys():
-            if symptom in text.lower():
-                if symptom not in symptoms:
-                    symptoms.append(symptom)
-        
-        return list(set(symptoms))  # Remove duplicates
+        return list(dict.fromkeys(symptoms))  # Remove duplicates, keep order of mention
     
     def check_emergency_keywords(self, text: str) -> Tuple[bool, List[str]]:
-        """Check for emergency keywords that trigger immediate critical triage"""
-        text_lower = text.lower()
-        found_keywords = []
-        
-        for keyword in self.emergency_keywords:
-            if keyword in text_lower:
-                found_keywords.append(keyword)
+        """Check lowercased text for emergency keywords that trigger immediate critical triage"""
+        # Single pass over the text; dict.fromkeys de-duplicates in order of mention
+        found_keywords = list(dict.fromkeys(EMERGENCY_KEYWORD_PATTERN.findall(text)))
         
         return len(found_keywords) > 0, found_keywords
     
@@ -92,24 +126,26 @@ class AITriageEngine:
         score = 0
         abnormalities = []
         
-        for vital_name, value in vitals.items():
-            if value is None or vital_name not in self.vital_thresholds:
+        for vital_name, critical_low, low, high, critical_high in self._vital_bounds:
+            value = vitals.get(vital_name)
+            if value is None:
                 continue
             
-            thresholds = self.vital_thresholds[vital_name]
-            
-            if value <= thresholds['critical_low'] or value >= thresholds['critical_high']:
+            if value <= critical_low or value >= critical_high:
                 score += 30
                 abnormalities.append(f"Critical {vital_name}: {value}")
-            elif value <= thresholds['low'] or value >= thresholds['high']:
+            elif value <= low or value >= high:
                 score += 15
                 abnormalities.append(f"Abnormal {vital_name}: {value}")
         
         return min(score, 50), abnormalities  # Cap vitals contribution at 50
     
-    def calculate_symptom_severity(self, symptoms: List[str], symptom_text: str) -> int:
-        """Calculate severity score based on detected symptoms"""
-        if not symptoms:
+    def calculate_symptom_severity(self, symptom_text: str) -> int:
+        """Calculate severity score based on known symptoms mentioned in the lowercased text"""
+        # Group numbers of the distinct symptoms mentioned
+        known_symptoms = dict.fromkeys(match.lastindex for match in self._symptom_re.finditer(symptom_text))
+        
+        if not known_symptoms:
             # Use basic text analysis if no specific symptoms detected
             severity_indicators = {
                 'severe': 20, 'extreme': 25, 'unbearable': 25, 'intense': 15,
@@ -118,62 +154,46 @@ class AITriageEngine:
             
             score = 30  # Base score
             for indicator, value in severity_indicators.items():
-                if indicator in symptom_text.lower():
+                if indicator in symptom_text:
                     score += value
             
             return min(max(score, 0), 70)
         
         # Calculate based on known symptoms
-        max_severity = 0
-        avg_severity = 0
-        
-        for symptom in symptoms:
-            # Check exact match
-            if symptom in self.symptom_severity_map:
-                severity = self.symptom_severity_map[symptom]
-                max_severity = max(max_severity, severity)
-                avg_severity += severity
-            else:
-                # Partial match
-                for known_symptom, severity in self.symptom_severity_map.items():
-                    if known_symptom in symptom or symptom in known_symptom:
-                        max_severity = max(max_severity, severity)
-                        avg_severity += severity
-                        break
-        
-        if len(symptoms) > 0:
-            avg_severity = avg_severity / len(symptoms)
+        severities = [self._symptom_severities[group - 1] for group in known_symptoms]
+        max_severity = max(severities)
+        avg_severity = sum(severities) / len(severities)
         
         # Weight toward maximum severity but consider average
         final_score = (max_severity * 0.7) + (avg_severity * 0.3)
         return int(final_score)
     
-    def predict_severity(self, symptom_text: str, vitals: Dict, duration: str = None) -> Dict:
+    def predict_severity(self, symptom_text: str, vitals: Dict, duration: str = None, doc=None) -> Dict:
         """
         Main prediction function that combines NLP, rule-based logic, and vital analysis
         Returns comprehensive triage result
         """
+        # Bound the scan length, then lowercase once; every scan below works on the same copy
+        symptom_text = symptom_text[:settings.MAX_SYMPTOM_TEXT_LENGTH]
+        text_lc = symptom_text.lower()
+        
         # Step 1: Check for emergency keywords (rule-based override)
-        is_emergency, emergency_flags = self.check_emergency_keywords(symptom_text)
+        is_emergency, emergency_flags = self.check_emergency_keywords(text_lc)
         
         if is_emergency:
             return {
-                'severity_score': 100,
-                'severity_level': 'critical',
-                'priority': 1,
+                **_EMERGENCY_TEMPLATE,
                 'symptoms_detected': emergency_flags,
                 'emergency_flags': emergency_flags,
                 'vital_abnormalities': [],
-                'ai_reasoning': f"Emergency keywords detected: {', '.join(emergency_flags)}. Immediate medical attention required.",
-                'rule_based_override': True,
-                'recommendation': "IMMEDIATE EMERGENCY CARE REQUIRED"
+                'ai_reasoning': f"Emergency keywords detected: {', '.join(emergency_flags)}. Immediate medical attention required."
             }
         
         # Step 2: Extract symptoms using NLP
-        symptoms = self.extract_symptoms(symptom_text)
+        symptoms = self.extract_symptoms(text_lc, doc)
         
         # Step 3: Calculate symptom severity
-        symptom_score = self.calculate_symptom_severity(symptoms, symptom_text)
+        symptom_score = self.calculate_symptom_severity(text_lc)
         
         # Step 4: Analyze vitals
         vital_score, vital_abnormalities = self.analyze_vitals(vitals)
@@ -183,24 +203,14 @@ class AITriageEngine:
         
         # Apply duration modifier
         if duration:
-            if 'chronic' in duration.lower() or 'weeks' in duration.lower() or 'months' in duration.lower():
+            duration_lc = duration.lower()
+            if 'chronic' in duration_lc or 'weeks' in duration_lc or 'months' in duration_lc:
                 total_score = min(total_score, 65)  # Chronic conditions rarely critical
-            elif 'sudden' in duration.lower() or 'acute' in duration.lower():
+            elif 'sudden' in duration_lc or 'acute' in duration_lc:
                 total_score = min(total_score + 10, 100)  # Sudden onset more concerning
         
         # Step 6: Determine severity level and priority
-        if total_score >= settings.CRITICAL_MIN:
-            severity_level = 'critical'
-            priority = 1
-            recommendation = "Immediate medical attention required. Priority patient."
-        elif total_score >= settings.MODERATE_MIN:
-            severity_level = 'moderate'
-            priority = 2
-            recommendation = "Medical evaluation needed soon. Moderate priority."
-        else:
-            severity_level = 'normal'
-            priority = 3
-            recommendation = "Standard consultation. Can wait for available slot."
+        severity_level, priority, recommendation = self.classify_score(total_score)
         
         # Step 7: Generate AI reasoning
         reasoning_parts = []
@@ -225,10 +235,33 @@ class AITriageEngine:
             'recommendation': recommendation
         }
     
+    def predict_severity_batch(self, items: List[Dict]) -> List[Dict]:
+        """
+        Score many assessments at once; items carry symptom_text, vitals and duration
+        Texts that need the parser go through a single nlp.pipe call
+        """
+        # Step 1: Only free text without any keyword hit reaches the parser
+        lowered = [item['symptom_text'][:settings.MAX_SYMPTOM_TEXT_LENGTH].lower() for item in items]
+        needs_parse = [
+            i for i, text_lc in enumerate(lowered)
+            if not EMERGENCY_KEYWORD_PATTERN.search(text_lc) and not self._symptom_re.search(text_lc)
+        ]
+        
+        # Step 2: Parse them together (skipped entirely, model load included, when nothing needs it)
+        texts = (lowered[i] for i in needs_parse)
+        docs = dict(zip(needs_parse, self.nlp.pipe(texts, batch_size=32))) if needs_parse else {}
+        
+        # Step 3: Score each item with its pre-parsed doc
+        return [
+            self.predict_severity(item['symptom_text'], item.get('vitals') or {}, item.get('duration'), docs.get(i))
+            for i, item in enumerate(items)
+        ]
+    
     def reassess_severity(self, original_score: int, follow_up_text: str, condition_change: str) -> Dict:
         """Reassess severity based on follow-up information"""
         # Extract new symptoms
-        symptoms = self.extract_symptoms(follow_up_text)
+        follow_up_lc = follow_up_text[:settings.MAX_SYMPTOM_TEXT_LENGTH].lower()
+        symptoms = self.extract_symptoms(follow_up_lc)
         
         # Adjust score based on condition change
         if condition_change == 'worsened':
@@ -242,21 +275,13 @@ class AITriageEngine:
             reasoning = "Condition remains stable."
         
         # Check for new emergency keywords
-        is_emergency, emergency_flags = self.check_emergency_keywords(follow_up_text)
+        is_emergency, emergency_flags = self.check_emergency_keywords(follow_up_lc)
         if is_emergency:
             new_score = 100
             reasoning += f" NEW EMERGENCY: {', '.join(emergency_flags)}"
         
         # Determine new severity level
-        if new_score >= settings.CRITICAL_MIN:
-            severity_level = 'critical'
-            priority = 1
-        elif new_score >= settings.MODERATE_MIN:
-            severity_level = 'moderate'
-            priority = 2
-        else:
-            severity_level = 'normal'
-            priority = 3
+        severity_level, priority, _ = self.classify_score(new_score)
         
         return {
             'severity_score': new_score,
@@ -269,4 +294,51 @@ class AITriageEngine:
         }
 
 # Singleton instance
-ai_engine = AITriageEngine()
\ No newline at end of file
+ai_engine = AITriageEngine()
+
+# Recent results by exact input, so retries and resubmits skip the pool entirely
+_result_cache: LRUCache = LRUCache(maxsize=2048)
+
+def _result_key(symptom_text: str, vitals: Dict, duration: Optional[str]) -> Optional[tuple]:
+    """Cache key for an assessment, or None if the vitals aren't hashable"""
+    key = (symptom_text, tuple(sorted(vitals.items())), duration)
+    try:
+        hash(key)
+    except TypeError:
+        return None
+    return key
+
+def score(symptom_text: str, vitals: Dict, duration: str = None) -> Dict:
+    """Pool entry point; each worker process reuses its module-level engine"""
+    return ai_engine.predict_severity(symptom_text, vitals, duration)
+
+async def predict_severity_async(symptom_text: str, vitals: Dict, duration: str = None) -> Dict:
+    """Run predict_severity in the process pool and await the result (memoized)"""
+    key = _result_key(symptom_text, vitals, duration)
+    cached = _result_cache.get(key) if key is not None else None
+    if cached is not None:
+        return dict(cached)  # Callers add fields to the result; keep the cached one intact
+    
+    loop = asyncio.get_running_loop()
+    result = await loop.run_in_executor(get_process_pool(), score, symptom_text, vitals, duration)
+    if key is not None:
+        _result_cache[key] = result
+    return dict(result)
+
+def reassess(original_score: int, follow_up_text: str, condition_change: str) -> Dict:
+    """Pool entry point for follow-up reassessment"""
+    return ai_engine.reassess_severity(original_score, follow_up_text, condition_change)
+
+async def reassess_severity_async(original_score: int, follow_up_text: str, condition_change: str) -> Dict:
+    """Run reassess_severity in the process pool and await the result"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(get_process_pool(), reassess, original_score, follow_up_text, condition_change)
+
+def score_batch(items: List[Dict]) -> List[Dict]:
+    """Pool entry point for a batch of assessments"""
+    return ai_engine.predict_severity_batch(items)
+
+async def predict_severity_batch_async(items: List[Dict]) -> List[Dict]:
+    """Run predict_severity_batch in the process pool and await the results"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(get_process_pool(), score_batch, items)
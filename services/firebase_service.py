@@ -1,10 +1,13 @@
 
 import os
 import json
+import asyncio
+from functools import lru_cache
 import firebase_admin
-from firebase_admin import credentials, firestore, messaging
+from firebase_admin import credentials, firestore, firestore_async, messaging
+from cachetools import TTLCache
 from typing import Dict, List, Optional
-from datetime import datetime
+from datetime import datetime, timezone
 
 class FirebaseService:
     def __init__(self):
@@ -43,60 +46,91 @@ class FirebaseService:
             firebase_admin.initialize_app(cred)
             print("✅ Firebase Admin SDK initialized")
         
-        # Get Firestore client
-        self.db = firestore.client()
+        # Get async Firestore client so queries yield to the event loop
+        self.db = firestore_async.client()
+        
+        # Recently read patients; demographics rarely change so a short TTL is safe
+        self._patient_cache: TTLCache = TTLCache(maxsize=4096, ttl=60)
+        
+        # Doctor records and device tokens, re-read on every notification fan-out otherwise
+        self._doctor_cache: TTLCache = TTLCache(maxsize=1024, ttl=300)
+    
+    # Bulk Operations
+    async def bulk_create(self, collection: str, docs: List[Dict]) -> List[str]:
+        """Create many documents with batched writes (Firestore allows 500 per batch)"""
+        doc_ids = []
+        commits = []
+        
+        for start in range(0, len(docs), 500):
+            batch = self.db.batch()
+            for doc_data in docs[start:start + 500]:
+                doc_ref = self.db.collection(collection).document()
+                batch.set(doc_ref, {**doc_data, 'created_at': firestore.SERVER_TIMESTAMP})
+                doc_ids.append(doc_ref.id)
+            commits.append(batch.commit())
+        
+        await asyncio.gather(*commits)
+        return doc_ids
     
     # Patient Operations
     async def create_patient(self, patient_data: Dict) -> str:
         """Create a new patient record"""
-        patient_data['created_at'] = datetime.utcnow()
-        patient_data['updated_at'] = datetime.utcnow()
+        # Stamped by Firestore on commit (one server time for both fields)
+        patient_data['created_at'] = firestore.SERVER_TIMESTAMP
+        patient_data['updated_at'] = firestore.SERVER_TIMESTAMP
         
         doc_ref = self.db.collection('patients').document()
-        doc_ref.set(patient_data)
+        await doc_ref.set(patient_data)
         return doc_ref.id
     
     async def get_patient(self, patient_id: str) -> Optional[Dict]:
-        """Get patient by ID"""
-        doc = self.db.collection('patients').document(patient_id).get()
+        """Get patient by ID (served from a 60 s cache when possible)"""
+        cached = self._patient_cache.get(patient_id)
+        if cached is not None:
+            return dict(cached)  # Copy so callers can't mutate the cached record
+        
+        doc = await self.db.collection('patients').document(patient_id).get()
         if doc.exists:
             data = doc.to_dict()
             data['id'] = doc.id
-            return data
+            self._patient_cache[patient_id] = data
+            return dict(data)
         return None
     
     async def update_patient(self, patient_id: str, update_data: Dict) -> bool:
         """Update patient record"""
-        update_data['updated_at'] = datetime.utcnow()
-        self.db.collection('patients').document(patient_id).update(update_data)
+        update_data['updated_at'] = firestore.SERVER_TIMESTAMP
+        await self.db.collection('patients').document(patient_id).update(update_data)
+        self._patient_cache.pop(patient_id, None)
         return True
     
-    async def get_patient_visits(self, patient_id: str, limit: int = 10) -> List[Dict]:
-        """Get patient visit history"""
-        visits = (
+    async def get_patient_visits(self, patient_id: str, limit: int = 10, fields: Optional[List[str]] = None) -> List[Dict]:
+        """Get patient visit history (fields: only fetch these document fields)"""
+        query = (
             self.db.collection('visits')
             .where('patient_id', '==', patient_id)
             .order_by('visit_date', direction=firestore.Query.DESCENDING)
             .limit(limit)
-            .stream()
         )
+        if fields:
+            query = query.select(fields)
         
-        return [{'id': v.id, **v.to_dict()} for v in visits]
+        return await _materialize(query.stream())
     
     # Visit Operations
     async def create_visit(self, visit_data: Dict) -> str:
         """Create a new visit record"""
-        visit_data['visit_date'] = datetime.utcnow()
+        visit_data['visit_date'] = firestore.SERVER_TIMESTAMP
         visit_data['status'] = 'active'
-        visit_data['created_at'] = datetime.utcnow()
+        visit_data['created_at'] = firestore.SERVER_TIMESTAMP
         
         doc_ref = self.db.collection('visits').document()
-        doc_ref.set(visit_data)
+        await doc_ref.set(visit_data)
         return doc_ref.id
     
     async def get_visit(self, visit_id: str) -> Optional[Dict]:
         """Get visit by ID"""
-        doc = self.db.collection('visits').document(visit_id).get()
+        doc = await self.db.collection('visits').document(visit_id).get()
         if doc.exists:
             data = doc.to_dict()
             data['id'] = doc.id
@@ -105,93 +139,130 @@ class FirebaseService:
     
     async def update_visit(self, visit_id: str, update_data: Dict) -> bool:
         """Update visit record"""
-        update_data['updated_at'] = datetime.utcnow()
-        self.db.collection('visits').document(visit_id).update(update_data)
+        update_data['updated_at'] = firestore.SERVER_TIMESTAMP
+        await self.db.collection('visits').document(visit_id).update(update_data)
         return True
     
     # Triage Operations
     async def save_triage_result(self, triage_data: Dict) -> str:
         """Save triage assessment result"""
-        triage_data['created_at'] = datetime.utcnow()
+        triage_data['created_at'] = firestore.SERVER_TIMESTAMP
         
         doc_ref = self.db.collection('triage_results').document()
-        doc_ref.set(triage_data)
+        await doc_ref.set(triage_data)
         return doc_ref.id
     
     # Queue Operations
+    # views/active_queue holds every waiting entry, sorted, in a single document so
+    # dashboard reads cost one document read instead of an ordered index scan.
+    # Writes update the source row and the view in one transaction.
     async def add_to_queue(self, queue_data: Dict) -> str:
         """Add patient to triage queue"""
+        # Client time on purpose: the entry is also copied into the view's array, where
+        # server timestamps aren't allowed, and the queue manager needs it locally
         queue_data['checked_in_at'] = datetime.utcnow()
         queue_data['status'] = 'waiting'
         
         doc_ref = self.db.collection('queue').document()
-        doc_ref.set(queue_data)
+        await _write_queue_entry(self.db.transaction(), self._queue_view_ref(), doc_ref, queue_data, None)
         return doc_ref.id
     
     async def get_queue(self) -> List[Dict]:
         """Get current queue ordered by priority"""
+        view = await self._queue_view_ref().get()
+        if view.exists:
+            return [dict(entry) for entry in view.to_dict().get('entries', [])]
+        
+        # No view yet (first run): build it from the collection
+        return await self.refresh_queue_view()
+    
+    async def refresh_queue_view(self) -> List[Dict]:
+        """Rebuild the active queue view from the queue collection"""
         queue = (
             self.db.collection('queue')
             .where('status', '==', 'waiting')
             .order_by('priority')
             .order_by('checked_in_at')
-            .stream()
         )
         
-        return [{'id': q.id, **q.to_dict()} for q in queue]
+        entries = await _rebuild_queue_view(self.db.transaction(), self._queue_view_ref(), queue)
+        return [dict(entry) for entry in entries]
     
     async def update_queue_entry(self, queue_id: str, update_data: Dict) -> bool:
         """Update queue entry"""
-        self.db.collection('queue').document(queue_id).update(update_data)
+        doc_ref = self.db.collection('queue').document(queue_id)
+        
+        # Positions are recomputed from the view order on every read; skip the view for them
+        if set(update_data) <= {'queue_position'}:
+            await doc_ref.update(update_data)
+            return True
+        
+        await _write_queue_entry(self.db.transaction(), self._queue_view_ref(), doc_ref, None, update_data)
         return True
     
     async def remove_from_queue(self, queue_id: str) -> bool:
         """Remove patient from queue"""
-        self.db.collection('queue').document(queue_id).delete()
+        doc_ref = self.db.collection('queue').document(queue_id)
+        await _write_queue_entry(self.db.transaction(), self._queue_view_ref(), doc_ref, None, None)
         return True
     
+    def _queue_view_ref(self):
+        return self.db.collection('views').document('active_queue')
+    
     # Alert Operations
     async def create_alert(self, alert_data: Dict) -> str:
         """Create a new alert"""
-        alert_data['created_at'] = datetime.utcnow()
+        alert_data['created_at'] = firestore.SERVER_TIMESTAMP
         alert_data['acknowledged'] = False
         
         doc_ref = self.db.collection('alerts').document()
-        doc_ref.set(alert_data)
+        await doc_ref.set(alert_data)
         return doc_ref.id
     
-    async def get_active_alerts(self) -> List[Dict]:
-        """Get unacknowledged alerts"""
-        alerts = (
+    async def get_active_alerts(self, limit: Optional[int] = None, cursor: Optional[datetime] = None) -> List[Dict]:
+        """Get unacknowledged alerts, newest first (limit/cursor: one page older than cursor)"""
+        query = (
             self.db.collection('alerts')
             .where('acknowledged', '==', False)
             .order_by('created_at', direction=firestore.Query.DESCENDING)
-            .stream()
         )
+        if cursor is not None:
+            query = query.start_after({'created_at': cursor})
+        if limit is not None:
+            query = query.limit(limit)
         
-        return [{'id': a.id, **a.to_dict()} for a in alerts]
+        return await _materialize(query.stream())
     
     async def acknowledge_alert(self, alert_id: str, doctor_id: str) -> bool:
         """Mark alert as acknowledged"""
-        self.db.collection('alerts').document(alert_id).update({
+        await self.db.collection('alerts').document(alert_id).update({
             'acknowledged': True,
             'acknowledged_by': doctor_id,
-            'acknowledged_at': datetime.utcnow()
+            'acknowledged_at': firestore.SERVER_TIMESTAMP
         })
         return True
     
     # Doctor Operations
     async def get_doctor(self, doctor_id: str) -> Optional[Dict]:
-        """Get doctor by ID"""
-        doc = self.db.collection('doctors').document(doctor_id).get()
+        """Get doctor by ID (cached for 5 minutes)"""
+        cached = self._doctor_cache.get(('id', doctor_id))
+        if cached is not None:
+            return dict(cached)
+        
+        doc = await self.db.collection('doctors').document(doctor_id).get()
         if doc.exists:
             data = doc.to_dict()
             data['id'] = doc.id
-            return data
+            self._doctor_cache[('id', doctor_id)] = data
+            return dict(data)
         return None
     
     async def get_doctor_by_email(self, email: str) -> Optional[Dict]:
-        """Get doctor by email"""
+        """Get doctor by email (cached for 5 minutes)"""
+        cached = self._doctor_cache.get(('email', email))
+        if cached is not None:
+            return dict(cached)
+        
         doctors = (
             self.db.collection('doctors')
             .where('email', '==', email)
@@ -199,21 +270,112 @@ class FirebaseService:
             .stream()
         )
         
-        for doc in doctors:
+        async for doc in doctors:
             data = doc.to_dict()
             data['id'] = doc.id
-            return data
+            self._doctor_cache[('email', email)] = data
+            return dict(data)
         
         return None
     
-    async def save_doctor_notes(self, notes_data: Dict) -> str:
+    async def get_doctor_devices(self, doctor_id: str) -> List[str]:
+        """Get FCM device tokens registered for a doctor (cached for 5 minutes)"""
+        cached = self._doctor_cache.get(('devices', doctor_id))
+        if cached is not None:
+            return list(cached)
+        
+        doc = await self.db.collection('doctors').document(doctor_id).get()
+        tokens = doc.to_dict().get('device_tokens', []) if doc.exists else []
+        self._doctor_cache[('devices', doctor_id)] = tokens
+        return list(tokens)
+    
+    async def get_doctor_devices_bulk(self, doctor_ids: List[str]) -> Dict[str, List[str]]:
+        """Get device tokens for many doctors with one 'in' query per 30 ids"""
+        devices = {}
+        missing = []
+        for doctor_id in dict.fromkeys(doctor_ids):
+            cached = self._doctor_cache.get(('devices', doctor_id))
+            if cached is not None:
+                devices[doctor_id] = list(cached)
+            else:
+                missing.append(doctor_id)
+        
+        doctors = self.db.collection('doctors')
+        queries = [
+            doctors
+            .where(firestore.FieldPath.document_id(), 'in', [doctors.document(d) for d in missing[i:i + 30]])
+            .select(['device_tokens'])
+            .stream()
+            for i in range(0, len(missing), 30)
+        ]
+        
+        for docs in await asyncio.gather(*[_materialize(q) for q in queries]):
+            for doc in docs:
+                devices[doc['id']] = doc.get('device_tokens', [])
+        
+        # Cache every miss, including doctors without a document or tokens
+        for doctor_id in missing:
+            tokens = devices.setdefault(doctor_id, [])
+            self._doctor_cache[('devices', doctor_id)] = list(tokens)
+        
+        return devices
+    
+    async def register_device_token(self, user_id: str, device_token: str, user_type: str) -> bool:
+        """Add an FCM device token to a user's document"""
+        collection = "doctors" if user_type == "doctor" else "patients"
+        # ArrayUnion adds the token server-side and merge creates the document or
+        # array if missing: one round trip, and concurrent registrations commute
+        await self.db.collection(collection).document(user_id).set({
+            'device_tokens': firestore.ArrayUnion([device_token]),
+            'updated_at': firestore.SERVER_TIMESTAMP
+        }, merge=True)
+        
+        if user_type == "doctor":
+            self.invalidate_doctor(user_id)
+        else:
+            self._patient_cache.pop(user_id, None)
+        return True
+    
+    def invalidate_doctor(self, doctor_id: str):
+        """Drop cached reads for a doctor after their document changes"""
+        self._doctor_cache.pop(('id', doctor_id), None)
+        self._doctor_cache.pop(('devices', doctor_id), None)
+        # Email entries are keyed by address; drop any that point at this doctor
+        for key in [k for k, v in self._doctor_cache.items() if k[0] == 'email' and v.get('id') == doctor_id]:
+            self._doctor_cache.pop(key, None)
+    
+    async def save_doctor_note(self, note_data: Dict) -> str:
         """Save doctor's consultation notes"""
-        notes_data['created_at'] = datetime.utcnow()
+        note_data['created_at'] = firestore.SERVER_TIMESTAMP
         
-        doc_ref = self.db.collection('doctor_notes').document()
-        doc_ref.set(notes_data)
+        # One note per visit, stored under the visit id so reads are a direct lookup
+        doc_ref = self.db.collection('doctor_notes').document(note_data['visit_id'])
+        await doc_ref.set(note_data)
         return doc_ref.id
     
+    async def get_visit_notes(self, visit_id: str) -> Optional[Dict]:
+        """Get the consultation notes saved for a visit"""
+        doc = await self.db.collection('doctor_notes').document(visit_id).get()
+        if doc.exists:
+            data = doc.to_dict()
+            data['id'] = doc.id
+            return data
+        
+        # Notes saved before they were keyed by visit id
+        notes = (
+            self.db.collection('doctor_notes')
+            .where('visit_id', '==', visit_id)
+            .limit(1)
+            .stream()
+        )
+        
+        async for doc in notes:
+            data = doc.to_dict()
+            data['id'] = doc.id
+            return data
+        
+        return None
+    
     # Firebase Cloud Messaging (FCM)
     async def send_notification(self, token: str, title: str, body: str, data: Dict = None) -> bool:
         """Send push notification via FCM"""
@@ -227,13 +389,40 @@ class FirebaseService:
                 token=token
             )
             
-            response = messaging.send(message)
+            response = await asyncio.to_thread(messaging.send, message)
             print(f"✅ Notification sent: {response}")
             return True
         except Exception as e:
             print(f"❌ Error sending notification: {e}")
             return False
     
+    async def send_multicast_notification(self, tokens: List[str], notification_data: Dict) -> Dict:
+        """Send one push notification to up to 500 device tokens in a single FCM request"""
+        try:
+            message = messaging.MulticastMessage(
+                notification=messaging.Notification(
+                    title=notification_data['title'],
+                    body=notification_data['body']
+                ),
+                # FCM data payloads only carry string values
+                data={k: str(v) for k, v in notification_data.get('data', {}).items()},
+                android=messaging.AndroidConfig(
+                    priority=notification_data.get('priority', 'high'),
+                    notification=messaging.AndroidNotification(sound=notification_data.get('sound', 'default'))
+                ),
+                apns=messaging.APNSConfig(
+                    payload=messaging.APNSPayload(aps=messaging.Aps(sound=notification_data.get('sound', 'default')))
+                ),
+                tokens=tokens
+            )
+            
+            response = await asyncio.to_thread(messaging.send_each_for_multicast, message)
+            print(f"✅ Multicast sent: {response.success_count} ok, {response.failure_count} failed")
+            return {'success_count': response.success_count, 'failure_count': response.failure_count}
+        except Exception as e:
+            print(f"❌ Error sending multicast notification: {e}")
+            return {'success_count': 0, 'failure_count': len(tokens)}
+    
     async def send_notification_to_topic(self, topic: str, title: str, body: str, data: Dict = None) -> bool:
         """Send notification to a topic (e.g., all doctors)"""
         try:
@@ -246,12 +435,62 @@ class FirebaseService:
                 topic=topic
             )
             
-            response = messaging.send(message)
+            response = await asyncio.to_thread(messaging.send, message)
             print(f"✅ Topic notification sent: {response}")
             return True
         except Exception as e:
             print(f"❌ Error sending topic notification: {e}")
             return False
 
-# Singleton instance
-firebase_service = FirebaseService()
\ No newline at end of file
+async def _materialize(stream) -> List[Dict]:
+    """Turn a stream of document snapshots into plain dicts carrying their id"""
+    return [{'id': doc.id, **doc.to_dict()} async for doc in stream]
+
+def _queue_order(entry: Dict):
+    """Sort key matching the queue query: priority, then check-in time"""
+    checked_in = entry['checked_in_at']
+    if checked_in.tzinfo is None:
+        # Freshly added entries are naive UTC; ones read back from Firestore are aware
+        checked_in = checked_in.replace(tzinfo=timezone.utc)
+    return entry['priority'], checked_in
+
+@firestore_async.async_transactional
+async def _write_queue_entry(transaction, view_ref, doc_ref, new_data: Optional[Dict], update_data: Optional[Dict]):
+    """
+    Apply one queue mutation to the source document and the active queue view
+    new_data creates the entry, update_data patches it, neither deletes it
+    """
+    # Step 1: Read the view (transactions read before they write)
+    view = await view_ref.get(transaction=transaction)
+    entries = view.to_dict().get('entries', []) if view.exists else []
+    
+    # Step 2: Write the source document and patch the matching view entry
+    if new_data is not None:
+        transaction.set(doc_ref, new_data)
+        entries.append({'id': doc_ref.id, **new_data})
+    elif update_data is not None:
+        transaction.update(doc_ref, update_data)
+        for entry in entries:
+            if entry['id'] == doc_ref.id:
+                entry.update(update_data)
+                break
+    else:
+        transaction.delete(doc_ref)
+        entries = [entry for entry in entries if entry['id'] != doc_ref.id]
+    
+    # Step 3: Keep only waiting entries, in queue order
+    entries = [entry for entry in entries if entry.get('status') == 'waiting']
+    entries.sort(key=_queue_order)
+    transaction.set(view_ref, {'entries': entries, 'updated_at': firestore.SERVER_TIMESTAMP})
+
+@firestore_async.async_transactional
+async def _rebuild_queue_view(transaction, view_ref, queue_query) -> List[Dict]:
+    """Replace the active queue view with the current query results"""
+    entries = await _materialize(await transaction.get(queue_query))
+    transaction.set(view_ref, {'entries': entries, 'updated_at': firestore.SERVER_TIMESTAMP})
+    return entries
+
+# Singleton instance, created on first use so importing this module doesn't connect to Firebase
+@lru_cache(maxsize=1)
+def get_firebase_service() -> FirebaseService:
+    return FirebaseService()
\ No newline at end of file
@@ -1,8 +1,17 @@
-from typing import Dict, List
+from typing import Dict, List, Optional
 from datetime import datetime
-from services.firebase_service import firebase_service
+from services.firebase_service import get_firebase_service
 from models.triage import Alert, NotificationPayload
 import uuid
+import re
+import asyncio
+
+# Messages mentioning an emergency escalate any alert to critical
+_EMERGENCY_RE = re.compile('emergency', re.IGNORECASE)
+
+# Fallback (title, priority, sound) for alert types without a template
+_DEFAULT_ALERT_TEMPLATE = ('System Alert', 'normal', 'default')
+_DEFAULT_PUSH_TEMPLATE = ('System Alert', 'high', 'default')
 
 class NotificationService:
     def __init__(self):
@@ -33,6 +42,15 @@ class NotificationService:
                 'sound': 'warning.mp3'
             }
         }
+        
+        # (title, priority, sound) per alert type, unpacked in one step on the hot path
+        self._templates = {
+            alert_type: (config['title'], config['priority'], config['sound'])
+            for alert_type, config in self.alert_types.items()
+        }
+        
+        # Alert types that are always critical
+        self._critical_types = frozenset(t for t in self.alert_types if 'critical' in t)
     
     async def create_alert(
         self,
@@ -41,29 +59,27 @@ class NotificationService:
         patient_name: str,
         visit_id: str,
         message: str,
-        data: Dict = {}
+        data: Optional[Dict] = None
     ) -> str:
         """Create an alert in the system"""
+        if data is None:
+            data = {}
         
-        alert_config = self.alert_types.get(alert_type, {
-            'title': 'System Alert',
-            'priority': 'normal',
-            'sound': 'default'
-        })
+        title, priority, _ = self._templates.get(alert_type, _DEFAULT_ALERT_TEMPLATE)
         
         # Determine severity
-        if alert_config['priority'] == 'high':
+        if priority == 'high':
             severity = 'high'
         else:
             severity = 'medium'
         
-        if 'critical' in alert_type.lower() or 'emergency' in message.lower():
+        if alert_type in self._critical_types or _EMERGENCY_RE.search(message):
             severity = 'critical'
         
         alert_data = {
             'type': alert_type,
             'severity': severity,
-            'title': alert_config['title'],
+            'title': title,
             'message': message,
             'patient_id': patient_id,
             'patient_name': patient_name,
@@ -71,59 +87,62 @@ class NotificationService:
             'data': data
         }
         
-        alert_id = await firebase_service.create_alert(alert_data)
+        alert_id = await get_firebase_service().create_alert(alert_data)
         return alert_id
     
     async def send_notification_to_doctors(
         self,
         alert_type: str,
         message: str,
-        data: Dict = {},
-        doctor_ids: List[str] = None
+        data: Optional[Dict] = None,
+        doctor_ids: Optional[List[str]] = None,
+        tokens: Optional[List[str]] = None
     ) -> Dict:
-        """Send push notifications to doctors"""
+        """Send push notifications to doctors (tokens: device tokens already collected)"""
+        if data is None:
+            data = {}
         
-        alert_config = self.alert_types.get(alert_type, {
-            'title': 'System Alert',
-            'priority': 'high',
-            'sound': 'default'
-        })
+        title, priority, sound = self._templates.get(alert_type, _DEFAULT_PUSH_TEMPLATE)
         
         notification_data = {
-            'title': alert_config['title'],
+            'title': title,
             'body': message,
             'data': {
                 'type': alert_type,
                 'timestamp': datetime.utcnow().isoformat(),
                 **data
             },
-            'priority': alert_config['priority'],
-            'sound': alert_config['sound']
+            'priority': priority,
+            'sound': sound
         }
         
-        # If specific doctors not specified, send to all available doctors
-        if not doctor_ids:
-            doctor_ids = await self.get_all_doctor_ids()
-        
-        # Get device tokens for all doctors
-        all_tokens = []
-        for doctor_id in doctor_ids:
-            tokens = await firebase_service.get_doctor_devices(doctor_id)
-            all_tokens.extend(tokens)
+        all_tokens = tokens if tokens is not None else await self.collect_doctor_tokens(doctor_ids)
         
         if not all_tokens:
             return {'success': False, 'message': 'No device tokens found'}
         
-        # Send multicast notification
-        result = await firebase_service.send_multicast_notification(all_tokens, notification_data)
+        # Send multicast notifications, 500 tokens per FCM request
+        results = await asyncio.gather(*[
+            get_firebase_service().send_multicast_notification(all_tokens[i:i + 500], notification_data)
+            for i in range(0, len(all_tokens), 500)
+        ])
         
         return {
             'success': True,
             'sent_to': len(all_tokens),
-            'success_count': result['success_count'],
-            'failure_count': result['failure_count']
+            'success_count': sum(r['success_count'] for r in results),
+            'failure_count': sum(r['failure_count'] for r in results)
         }
     
+    async def collect_doctor_tokens(self, doctor_ids: Optional[List[str]] = None) -> List[str]:
+        """Device tokens for the given doctors (all available doctors if not specified)"""
+        if not doctor_ids:
+            doctor_ids = await self.get_all_doctor_ids()
+        
+        # Get device tokens for all doctors in bulk
+        devices = await get_firebase_service().get_doctor_devices_bulk(doctor_ids)
+        return [token for tokens in devices.values() for token in tokens]
+    
     async def notify_severity_change(
         self,
         patient_id: str,
@@ -142,18 +161,21 @@ class NotificationService:
             alert_type = 'severity_change'
             message = f"⚠️ {patient_name}'s severity changed from {old_severity.upper()} to {new_severity.upper()} (Score: {severity_score})"
         
-        # Create alert
-        await self.create_alert(
-            alert_type=alert_type,
-            patient_id=patient_id,
-            patient_name=patient_name,
-            visit_id=visit_id,
-            message=message,
-            data={
-                'old_severity': old_severity,
-                'new_severity': new_severity,
-                'severity_score': severity_score
-            }
+        # Store the alert while collecting device tokens
+        _, tokens = await asyncio.gather(
+            self.create_alert(
+                alert_type=alert_type,
+                patient_id=patient_id,
+                patient_name=patient_name,
+                visit_id=visit_id,
+                message=message,
+                data={
+                    'old_severity': old_severity,
+                    'new_severity': new_severity,
+                    'severity_score': severity_score
+                }
+            ),
+            self.collect_doctor_tokens()
         )
         
         # Send push notification
@@ -165,7 +187,8 @@ class NotificationService:
                 'visit_id': visit_id,
                 'severity': new_severity,
                 'score': severity_score
-            }
+            },
+            tokens=tokens
         )
     
     async def notify_vital_deterioration(
@@ -180,15 +203,20 @@ class NotificationService:
         abnormalities_str = ', '.join(abnormalities[:3])
         message = f"⚠️ {patient_name}'s vital signs abnormal: {abnormalities_str}"
         
-        await self.create_alert(
-            alert_type='vital_deterioration',
-            patient_id=patient_id,
-            patient_name=patient_name,
-            visit_id=visit_id,
-            message=message,
-            data={'abnormalities': abnormalities}
+        # Store the alert while collecting device tokens
+        _, tokens = await asyncio.gather(
+            self.create_alert(
+                alert_type='vital_deterioration',
+                patient_id=patient_id,
+                patient_name=patient_name,
+                visit_id=visit_id,
+                message=message,
+                data={'abnormalities': abnormalities}
+            ),
+            self.collect_doctor_tokens()
         )
         
+        # Send push notification
         await self.send_notification_to_doctors(
             alert_type='vital_deterioration',
             message=message,
@@ -196,7 +224,8 @@ class NotificationService:
                 'patient_id': patient_id,
                 'visit_id': visit_id,
                 'abnormalities': abnormalities
-            }
+            },
+            tokens=tokens
         )
     
     async def notify_long_wait(
@@ -211,18 +240,23 @@ class NotificationService:
         
         message = f"⏰ {patient_name} ({severity_level.upper()}) has been waiting for {wait_time_minutes} minutes"
         
-        await self.create_alert(
-            alert_type='long_wait',
-            patient_id=patient_id,
-            patient_name=patient_name,
-            visit_id=visit_id,
-            message=message,
-            data={
-                'wait_time_minutes': wait_time_minutes,
-                'severity_level': severity_level
-            }
+        # Store the alert while collecting device tokens
+        _, tokens = await asyncio.gather(
+            self.create_alert(
+                alert_type='long_wait',
+                patient_id=patient_id,
+                patient_name=patient_name,
+                visit_id=visit_id,
+                message=message,
+                data={
+                    'wait_time_minutes': wait_time_minutes,
+                    'severity_level': severity_level
+                }
+            ),
+            self.collect_doctor_tokens()
         )
         
+        # Send push notification
         await self.send_notification_to_doctors(
             alert_type='long_wait',
             message=message,
@@ -230,7 +264,8 @@ class NotificationService:
                 'patient_id': patient_id,
                 'visit_id': visit_id,
                 'wait_time': wait_time_minutes
-            }
+            },
+            tokens=tokens
         )
     
     async def notify_follow_up_worsening(
@@ -246,19 +281,24 @@ class NotificationService:
         score_increase = new_score - original_score
         message = f"⚠️ {patient_name}'s condition worsened on follow-up. Severity increased by {score_increase} points (now {new_score})"
         
-        await self.create_alert(
-            alert_type='follow_up_worsening',
-            patient_id=patient_id,
-            patient_name=patient_name,
-            visit_id=visit_id,
-            message=message,
-            data={
-                'original_score': original_score,
-                'new_score': new_score,
-                'score_change': score_increase
-            }
+        # Store the alert while collecting device tokens
+        _, tokens = await asyncio.gather(
+            self.create_alert(
+                alert_type='follow_up_worsening',
+                patient_id=patient_id,
+                patient_name=patient_name,
+                visit_id=visit_id,
+                message=message,
+                data={
+                    'original_score': original_score,
+                    'new_score': new_score,
+                    'score_change': score_increase
+                }
+            ),
+            self.collect_doctor_tokens()
         )
         
+        # Send push notification
         await self.send_notification_to_doctors(
             alert_type='follow_up_worsening',
             message=message,
@@ -266,16 +306,17 @@ class NotificationService:
                 'patient_id': patient_id,
                 'visit_id': visit_id,
                 'new_score': new_score
-            }
+            },
+            tokens=tokens
         )
     
-    async def get_active_alerts(self) -> List[Dict]:
-        """Get all unacknowledged alerts"""
-        return await firebase_service.get_active_alerts()
+    async def get_active_alerts(self, limit: Optional[int] = None, cursor: Optional[datetime] = None) -> List[Dict]:
+        """Get unacknowledged alerts (all of them unless limit is given)"""
+        return await get_firebase_service().get_active_alerts(limit=limit, cursor=cursor)
     
     async def acknowledge_alert(self, alert_id: str, doctor_id: str) -> bool:
         """Mark an alert as acknowledged"""
-        return await firebase_service.acknowledge_alert(alert_id, doctor_id)
+        return await get_firebase_service().acknowledge_alert(alert_id, doctor_id)
     
     async def get_all_doctor_ids(self) -> List[str]:
         """Get all registered doctor IDs"""
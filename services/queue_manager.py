@@ -1,17 +1,52 @@
-from typing import List, Dict, Optional
-from datetime import datetime, timedelta
+from typing import Callable, List, Dict, Optional, Tuple
+from datetime import datetime, timedelta, timezone
 import asyncio
+import heapq
+import time
+from itertools import chain
+from sortedcontainers import SortedKeyList
+from config import settings
 from models.triage import QueueEntry, SeverityLevel
-from services.firebase_service import firebase_service
+from services.firebase_service import get_firebase_service
 
 class QueueManager:
     def __init__(self):
         self.queue_cache: List[Dict] = []
+        self._checked_in_ts: List[float] = []
+        
+        # One bucket per priority (1 = highest), each ordered by check-in time;
+        # queue_cache is these buckets concatenated in priority order
+        self.buckets: Dict[int, SortedKeyList] = {}
+        self._by_visit: Dict[str, Dict] = {}  # Waiting entries by visit id
+        
+        # Running totals over the waiting entries for get_queue_statistics
+        self._counts = {'critical': 0, 'moderate': 0, 'normal': 0}
+        self._wait_sum = 0
+        
+        # queue_position last written to Firebase per entry id
+        self._last_positions: Dict[str, int] = {}
+        self._flush_task: Optional[asyncio.Task] = None
+        self._flush_pending = False
+        
+        # Called after every local mutation (main wires it to the queue-update broadcast)
+        self.change_listener: Optional[Callable[[], None]] = None
         self.wait_time_estimates = {
             'critical': 0,      # Immediate
             'moderate': 15,     # 15 minutes
             'normal': 30        # 30 minutes
         }
+        self.long_wait_thresholds = {
+            'critical': 5,      # 5 minutes
+            'moderate': 30,     # 30 minutes
+            'normal': 60        # 60 minutes
+        }
+        self.long_wait_realert_seconds = 300  # Repeat alert while patient keeps waiting
+        
+        # Min-heap of (deadline_ts, visit_id) for long-wait alerts; entries whose
+        # deadline no longer matches wait_deadlines[visit_id] are stale and skipped
+        self.wait_deadline_heap: List[Tuple[float, str]] = []
+        self.wait_deadlines: Dict[str, float] = {}
+        self.deadlines_changed = asyncio.Event()
     
     async def add_to_queue(self, queue_entry: Dict) -> Dict:
         """Add a patient to the priority queue"""
@@ -19,42 +54,83 @@ class QueueManager:
         queue_entry['estimated_wait_time'] = await self.calculate_wait_time(queue_entry['severity_level'])
         
         # Save to Firebase
-        entry_id = await firebase_service.add_to_queue(queue_entry)
+        entry_id = await get_firebase_service().add_to_queue(queue_entry)
         queue_entry['id'] = entry_id
+        self._normalize_checked_in(queue_entry)
+        self.schedule_wait_deadline(queue_entry)
         
-        # Refresh queue and update positions
-        await self.refresh_queue()
+        # Insert locally and write the positions that moved in the background
+        self._apply_local(queue_entry)
+        self._schedule_flush()
+        self._notify_change()
         
         return queue_entry
     
     async def refresh_queue(self) -> List[Dict]:
         """Refresh the queue from Firebase and recalculate positions"""
         # Get current queue from Firebase
-        self.queue_cache = await firebase_service.get_queue()
-        
-        # Sort by priority (1 = highest) and then by check-in time
-        self.queue_cache.sort(key=lambda x: (x['priority'], x['checked_in_at']))
+        entries = await get_firebase_service().get_queue()
+        
+        # Bucket by priority (1 = highest), each bucket ordered by check-in time
+        self.buckets = {}
+        for entry in entries:
+            self._normalize_checked_in(entry)
+            self._bucket(entry['priority']).add(entry)
+        self._by_visit = {entry['visit_id']: entry for entry in entries}
+        self._counts = dict.fromkeys(self._counts, 0)
+        self._wait_sum = 0
+        for entry in entries:
+            self._tally(entry, 1)
+        self._rebuild_queue_cache()
+        
+        # Track deadlines for entries added by other workers or before a restart
+        for entry in self.queue_cache:
+            if entry['visit_id'] not in self.wait_deadlines:
+                self.schedule_wait_deadline(entry)
         
-        # Update queue positions
-        for position, entry in enumerate(self.queue_cache, start=1):
-            entry['queue_position'] = position
-            
-            # Update position in Firebase
-            await firebase_service.update_queue_entry(
-                entry['id'],
-                {'queue_position': position}
-            )
+        await self.flush_positions()
         
         return self.queue_cache
     
+    async def flush_positions(self):
+        """Write queue positions that changed since the last flush to Firebase"""
+        positions = {entry['id']: entry['queue_position'] for entry in self.queue_cache}
+        changed = [
+            (entry_id, position) for entry_id, position in positions.items()
+            if self._last_positions.get(entry_id) != position
+        ]
+        
+        # Write concurrently; one failed write doesn't cancel the rest
+        results = await asyncio.gather(*[
+            get_firebase_service().update_queue_entry(entry_id, {'queue_position': position})
+            for entry_id, position in changed
+        ], return_exceptions=True)
+        
+        # Failed writes are left out so the next flush retries them
+        failed = 0
+        for (entry_id, _), result in zip(changed, results):
+            if isinstance(result, Exception):
+                positions.pop(entry_id)
+                failed += 1
+        self._last_positions = positions
+        
+        if failed:
+            print(f"⚠️ {failed} queue position update(s) failed")
+    
+    async def reconcile_loop(self):
+        """Re-read the queue from Firebase periodically to pick up changes made elsewhere"""
+        while True:
+            # Runs once right away so the cache is warm after a restart
+            try:
+                await self.refresh_queue()
+            except Exception as e:
+                print(f"Queue reconcile error: {e}")
+            await asyncio.sleep(settings.QUEUE_RECONCILE_INTERVAL)
+    
     async def update_severity(self, visit_id: str, new_severity_score: int, new_severity_level: str) -> Dict:
         """Update patient severity and reorder queue"""
         # Find the entry in queue
-        entry = None
-        for e in self.queue_cache:
-            if e['visit_id'] == visit_id:
-                entry = e
-                break
+        entry = self._by_visit.get(visit_id)
         
         if not entry:
             return {'error': 'Entry not found in queue'}
@@ -62,27 +138,33 @@ class QueueManager:
         old_severity = entry['severity_level']
         old_priority = entry['priority']
         
-        # Update severity
-        entry['severity_score'] = new_severity_score
-        entry['severity_level'] = new_severity_level
-        
         # Update priority based on new severity
         if new_severity_level == 'critical':
-            entry['priority'] = 1
+            new_priority = 1
         elif new_severity_level == 'moderate':
-            entry['priority'] = 2
+            new_priority = 2
         else:
-            entry['priority'] = 3
+            new_priority = 3
         
-        # Update in Firebase
-        await firebase_service.update_queue_entry(entry['id'], {
+        # Update in Firebase first; the cached entry only changes once the write succeeded
+        await get_firebase_service().update_queue_entry(entry['id'], {
             'severity_score': new_severity_score,
             'severity_level': new_severity_level,
-            'priority': entry['priority']
+            'priority': new_priority
         })
         
-        # Refresh queue to reorder
-        await self.refresh_queue()
+        # Update severity
+        entry['severity_score'] = new_severity_score
+        entry['severity_level'] = new_severity_level
+        entry['priority'] = new_priority
+        
+        # New severity means a new long-wait threshold
+        self.schedule_wait_deadline(entry)
+        
+        # Reorder locally and write the positions that moved in the background
+        self._apply_local(entry, old_priority=old_priority, old_severity=old_severity)
+        self._schedule_flush()
+        self._notify_change()
         
         # Check if severity changed significantly
         severity_changed = (old_severity != new_severity_level)
@@ -98,58 +180,58 @@ class QueueManager:
     
     async def call_patient(self, visit_id: str, doctor_id: str) -> Dict:
         """Mark patient as called and in progress"""
-        entry = None
-        for e in self.queue_cache:
-            if e['visit_id'] == visit_id:
-                entry = e
-                break
+        entry = self._by_visit.get(visit_id)
         
         if not entry:
             return {'error': 'Entry not found'}
         
-        # Update status
-        await firebase_service.update_queue_entry(entry['id'], {
-            'status': 'in_progress',
-            'called_at': datetime.utcnow(),
-            'assigned_doctor_id': doctor_id
-        })
-        
-        # Update visit
-        await firebase_service.update_visit(visit_id, {
-            'status': 'in_progress',
-            'assigned_doctor_id': doctor_id
-        })
-        
-        # Refresh queue
-        await self.refresh_queue()
+        # Update queue entry and visit status concurrently
+        results = await asyncio.gather(
+            get_firebase_service().update_queue_entry(entry['id'], {
+                'status': 'in_progress',
+                'called_at': datetime.utcnow(),
+                'assigned_doctor_id': doctor_id
+            }),
+            get_firebase_service().update_visit(visit_id, {
+                'status': 'in_progress',
+                'assigned_doctor_id': doctor_id
+            }),
+            return_exceptions=True
+        )
+        _raise_first_error(results)
+        self.wait_deadlines.pop(visit_id, None)
+        
+        # No longer waiting: drop locally and write the positions that moved in the background
+        self._apply_local(entry, removed=True)
+        self._schedule_flush()
+        self._notify_change()
         
         return {'success': True, 'entry': entry}
     
     async def complete_visit(self, visit_id: str) -> Dict:
         """Mark visit as completed and remove from queue"""
-        entry = None
-        entry_id = None
-        
-        for e in self.queue_cache:
-            if e['visit_id'] == visit_id:
-                entry = e
-                entry_id = e['id']
-                break
+        entry = self._by_visit.get(visit_id)
         
         if not entry:
             return {'error': 'Entry not found'}
-        
-        # Remove from queue
-        await firebase_service.remove_from_queue(entry_id)
-        
-        # Update visit status
-        await firebase_service.update_visit(visit_id, {
-            'status': 'completed',
-            'completed_at': datetime.utcnow()
-        })
-        
-        # Refresh queue
-        await self.refresh_queue()
+        entry_id = entry['id']
+        
+        # Remove from queue and update visit status concurrently
+        results = await asyncio.gather(
+            get_firebase_service().remove_from_queue(entry_id),
+            get_firebase_service().update_visit(visit_id, {
+                'status': 'completed',
+                'completed_at': datetime.utcnow()
+            }),
+            return_exceptions=True
+        )
+        _raise_first_error(results)
+        self.wait_deadlines.pop(visit_id, None)
+        
+        # Drop locally and write the positions that moved in the background
+        self._apply_local(entry, removed=True)
+        self._schedule_flush()
+        self._notify_change()
         
         return {'success': True}
     
@@ -157,66 +239,195 @@ class QueueManager:
         """Calculate estimated wait time based on queue and severity"""
         base_time = self.wait_time_estimates.get(severity_level, 30)
         
-        # Count patients ahead in queue with same or higher priority
+        # Count patients ahead in queue with higher severity (running totals, no scan)
         if severity_level == 'critical':
             ahead = 0  # Critical always goes first
         elif severity_level == 'moderate':
-            ahead = sum(1 for e in self.queue_cache if e['severity_level'] == 'critical')
+            ahead = self._counts['critical']
         else:  # normal
-            ahead = sum(1 for e in self.queue_cache if e['severity_level'] in ['critical', 'moderate'])
+            ahead = self._counts['critical'] + self._counts['moderate']
         
         # Estimate 10 minutes per patient ahead
         estimated_time = base_time + (ahead * 10)
         
         return estimated_time
     
-    async def get_queue_statistics(self) -> Dict:
-        """Get queue statistics"""
-        await self.refresh_queue()
+    async def get_queue_statistics(self, refresh: bool = False) -> Dict:
+        """Get queue statistics from the local queue (refresh=True re-reads Firebase first)"""
+        if refresh:
+            await self.refresh_queue()
         
         total = len(self.queue_cache)
-        critical = sum(1 for e in self.queue_cache if e['severity_level'] == 'critical')
-        moderate = sum(1 for e in self.queue_cache if e['severity_level'] == 'moderate')
-        normal = sum(1 for e in self.queue_cache if e['severity_level'] == 'normal')
-        
-        avg_wait_time = sum(e.get('estimated_wait_time', 0) for e in self.queue_cache) / total if total > 0 else 0
+        avg_wait_time = self._wait_sum / total if total > 0 else 0
         
         return {
             'total_patients': total,
-            'critical_count': critical,
-            'moderate_count': moderate,
-            'normal_count': normal,
+            'critical_count': self._counts['critical'],
+            'moderate_count': self._counts['moderate'],
+            'normal_count': self._counts['normal'],
             'average_wait_time': int(avg_wait_time),
             'queue': self.queue_cache
         }
     
+    def _bucket(self, priority: int) -> SortedKeyList:
+        """Bucket for a priority, created on first use"""
+        bucket = self.buckets.get(priority)
+        if bucket is None:
+            bucket = self.buckets[priority] = SortedKeyList(key=self._checked_in_timestamp)
+        return bucket
+    
+    def _rebuild_queue_cache(self):
+        """Concatenate the buckets in priority order and renumber positions"""
+        self.queue_cache = list(chain.from_iterable(
+            self.buckets[priority] for priority in sorted(self.buckets)
+        ))
+        for position, entry in enumerate(self.queue_cache, start=1):
+            entry['queue_position'] = position
+        
+        # Check-in times as POSIX seconds, parallel to queue_cache, for the long-wait scan
+        self._checked_in_ts = [self._checked_in_timestamp(entry) for entry in self.queue_cache]
+    
+    def _apply_local(self, entry: Dict, old_priority: Optional[int] = None,
+                     old_severity: Optional[str] = None, removed: bool = False):
+        """Insert, move (old_priority/old_severity given) or remove one entry in the local queue"""
+        # Take out whatever object is cached for this visit now; a refresh_queue that ran while
+        # the caller awaited Firestore may have replaced `entry` with a fresh copy
+        current = self._by_visit.get(entry['visit_id'])
+        if current is not None:
+            if current is entry:
+                self._tally(current, -1, old_severity)
+                priority = entry['priority'] if old_priority is None else old_priority
+            else:
+                self._tally(current, -1)
+                priority = current['priority']
+            self._bucket(priority).discard(current)
+        
+        if not removed:
+            self._tally(entry, 1)
+        
+        if removed:
+            self._by_visit.pop(entry['visit_id'], None)
+        else:
+            self._bucket(entry['priority']).add(entry)
+            self._by_visit[entry['visit_id']] = entry
+        self._rebuild_queue_cache()
+    
+    def _tally(self, entry: Dict, sign: int, severity_level: Optional[str] = None):
+        """Add (sign=1) or take back (sign=-1) an entry's share of the running totals"""
+        level = severity_level or entry['severity_level']
+        if level in self._counts:
+            self._counts[level] += sign
+        self._wait_sum += sign * entry.get('estimated_wait_time', 0)
+    
+    def _notify_change(self):
+        """Tell the change listener, if any, that the local queue changed"""
+        if self.change_listener is not None:
+            self.change_listener()
+    
+    def _schedule_flush(self):
+        """Run flush_positions in the background; a burst of mutations shares one follow-up flush"""
+        self._flush_pending = True
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush_loop())
+    
+    async def _flush_loop(self):
+        """Flush until no mutation arrived during the previous flush"""
+        while self._flush_pending:
+            self._flush_pending = False
+            await self.flush_positions()
+    
+    def peek_next(self) -> Optional[Dict]:
+        """Next patient to be seen: earliest check-in in the highest non-empty bucket"""
+        for priority in sorted(self.buckets):
+            if self.buckets[priority]:
+                return self.buckets[priority][0]
+        return None
+    
+    def _normalize_checked_in(self, entry: Dict):
+        """Parse checked_in_at into an aware UTC datetime, once when the entry enters the cache"""
+        checked_in = entry.get('checked_in_at')
+        if isinstance(checked_in, str):
+            checked_in = datetime.fromisoformat(checked_in.replace('Z', '+00:00'))
+        if checked_in.tzinfo is None:
+            checked_in = checked_in.replace(tzinfo=timezone.utc)
+        entry['checked_in_at'] = checked_in
+    
+    def _checked_in_timestamp(self, entry: Dict) -> float:
+        """Get an entry's check-in time as POSIX seconds"""
+        return entry['checked_in_at'].timestamp()
+    
+    def schedule_wait_deadline(self, entry: Dict, deadline: Optional[float] = None):
+        """Arm (or re-arm) the long-wait alert deadline for a queue entry"""
+        if deadline is None:
+            threshold = self.long_wait_thresholds.get(entry['severity_level'], 60)
+            deadline = self._checked_in_timestamp(entry) + threshold * 60
+        
+        self.wait_deadlines[entry['visit_id']] = deadline
+        heapq.heappush(self.wait_deadline_heap, (deadline, entry['visit_id']))
+        self.deadlines_changed.set()
+    
+    def next_wait_deadline(self) -> Optional[float]:
+        """Earliest pending long-wait deadline, if any"""
+        return self.wait_deadline_heap[0][0] if self.wait_deadline_heap else None
+    
+    def pop_expired_wait_deadlines(self) -> List[Dict]:
+        """Pop passed deadlines and return long-wait info for patients still waiting"""
+        now = time.time()
+        expired = []
+        
+        while self.wait_deadline_heap and self.wait_deadline_heap[0][0] <= now:
+            deadline, visit_id = heapq.heappop(self.wait_deadline_heap)
+            if self.wait_deadlines.get(visit_id) != deadline:
+                continue  # Superseded by a newer deadline or already left the queue
+            
+            entry = self._by_visit.get(visit_id)
+            if entry is None:
+                self.wait_deadlines.pop(visit_id, None)
+                continue
+            
+            wait_time = (now - self._checked_in_timestamp(entry)) / 60
+            threshold = self.long_wait_thresholds.get(entry['severity_level'], 60)
+            expired.append({
+                'entry': entry,
+                'wait_time_minutes': int(wait_time),
+                'threshold_exceeded': int(wait_time - threshold)
+            })
+            
+            # Keep alerting periodically while the patient is still waiting
+            self.schedule_wait_deadline(entry, now + self.long_wait_realert_seconds)
+        
+        return expired
+    
     async def check_long_wait_patients(self) -> List[Dict]:
         """Check for patients waiting too long"""
-        long_wait_threshold = {
-            'critical': 5,      # 5 minutes
-            'moderate': 30,     # 30 minutes
-            'normal': 60        # 60 minutes
-        }
+        long_wait_threshold = self.long_wait_thresholds
         
         long_wait_patients = []
-        current_time = datetime.utcnow()
+        now = time.time()
         
-        for entry in self.queue_cache:
-            checked_in = entry.get('checked_in_at')
-            if isinstance(checked_in, str):
-                checked_in = datetime.fromisoformat(checked_in.replace('Z', '+00:00'))
+        # Latest check-in time (POSIX seconds) that already counts as a long wait, per severity
+        cutoffs = {level: now - minutes * 60 for level, minutes in long_wait_threshold.items()}
+        default_cutoff = now - 60 * 60
+        
+        for entry, checked_in in zip(self.queue_cache, self._checked_in_ts):
+            if checked_in >= cutoffs.get(entry['severity_level'], default_cutoff):
+                continue
             
-            wait_time = (current_time - checked_in).total_seconds() / 60  # Convert to minutes
+            wait_time = (now - checked_in) / 60  # Convert to minutes
             threshold = long_wait_threshold.get(entry['severity_level'], 60)
-            
-            if wait_time > threshold:
-                long_wait_patients.append({
-                    'entry': entry,
-                    'wait_time_minutes': int(wait_time),
-                    'threshold_exceeded': int(wait_time - threshold)
-                })
+            long_wait_patients.append({
+                'entry': entry,
+                'wait_time_minutes': int(wait_time),
+                'threshold_exceeded': int(wait_time - threshold)
+            })
         
         return long_wait_patients
 
+def _raise_first_error(results: List):
+    """Re-raise the first exception from a gather(return_exceptions=True), once every write has settled"""
+    for result in results:
+        if isinstance(result, BaseException):
+            raise result
+
 # Singleton instance
 queue_manager = QueueManager()
\ No newline at end of file
@@ -3,52 +3,19 @@ Real AI Service for Medical Triage Analysis
 Supports both OpenAI (GPT-4) and Anthropic (Claude) APIs
 """
 
-import json
+import copy
+import asyncio
+import hashlib
+import random
 import aiohttp
+import orjson
 from typing import Dict, List, Optional
 from config import settings
 
-class RealAITriageEngine:
-    """
-    Advanced AI-powered medical triage engine using real LLM APIs
-    """
-    
-    def __init__(self):
-        self.provider = settings.AI_MODEL_PROVIDER
-        self.openai_key = settings.OPENAI_API_KEY
-        self.anthropic_key = settings.ANTHROPIC_API_KEY
-        
-        # Validate API keys
-        if self.provider == "openai" and not self.openai_key:
-            raise ValueError("OpenAI API key not configured. Set OPENAI_API_KEY in environment.")
-        if self.provider == "anthropic" and not self.anthropic_key:
-            raise ValueError("Anthropic API key not configured. Set ANTHROPIC_API_KEY in environment.")
-    
-    def _build_medical_prompt(self, symptom_text: str, vitals: Dict, age: int, 
-                             pain_level: int, duration: str, comorbidities: List[str]) -> str:
-        """Build comprehensive medical prompt for AI analysis"""
-        
-        prompt = f"""You are an expert emergency medicine physician AI assistant. Analyze this patient case and provide a comprehensive triage assessment.
-
-PATIENT INFORMATION:
-- Age: {age} years old
-- Pain Level: {pain_level}/10
-- Duration of Symptoms: {duration or 'Not specified'}
-- Pre-existing Conditions: {', '.join(comorbidities) if comorbidities else 'None reported'}
-
-CHIEF COMPLAINT & SYMPTOMS:
-{symptom_text}
+# Task description, response schema and scoring guidelines shared by every triage prompt
+_PROMPT_STATIC = """TASK: Provide a comprehensive medical triage assessment. Respond ONLY with valid JSON (no markdown, no code blocks):
 
-VITAL SIGNS:
-- Temperature: {vitals.get('temperature', 'Not recorded')}°C
-- Heart Rate: {vitals.get('heart_rate', 'Not recorded')} bpm
-- Blood Pressure: {vitals.get('blood_pressure_systolic', 'Not recorded')}/{vitals.get('blood_pressure_diastolic', 'Not recorded')} mmHg
-- Respiratory Rate: {vitals.get('respiratory_rate', 'Not recorded')} breaths/min
-- Oxygen Saturation: {vitals.get('oxygen_saturation', 'Not recorded')}%
-
-TASK: Provide a comprehensive medical triage assessment. Respond ONLY with valid JSON (no markdown, no code blocks):
-
-{{
+{
   "severity_score": <integer 0-100>,
   "severity_level": "<critical|moderate|normal>",
   "priority": <1|2|3>,
@@ -56,14 +23,14 @@ TASK: Provide a comprehensive medical triage assessment. Respond ONLY with valid
   "detected_symptoms": ["<symptom 1>", "<symptom 2>", "<symptom 3>"],
   "vital_abnormalities": ["<abnormality 1 with value>", "<abnormality 2 with value>"],
   "differential_diagnosis": [
-    {{"diagnosis": "<condition name>", "probability": <0-100>}},
-    {{"diagnosis": "<condition name>", "probability": <0-100>}}
+    {"diagnosis": "<condition name>", "probability": <0-100>},
+    {"diagnosis": "<condition name>", "probability": <0-100>}
   ],
   "clinical_concerns": ["<concern 1>", "<concern 2>"],
   "recommendations": ["<action 1>", "<action 2>", "<action 3>"],
   "reasoning": "<detailed 2-3 sentence explanation of severity assessment>",
   "confidence": <0-100>
-}}
+}
 
 SCORING GUIDELINES:
 - 0-39 (Normal): Minor conditions, stable vitals, can wait 30+ minutes
@@ -75,7 +42,93 @@ Priority: 1=Critical (immediate), 2=Moderate (urgent), 3=Normal (standard)
 
 Provide top 3-5 differential diagnoses with probability estimates based on clinical presentation."""
 
-        return prompt
+# Transient provider responses worth retrying (rate limited or briefly unavailable)
+_RETRY_STATUSES = frozenset({429, 500, 502, 503, 504})
+_MAX_RETRY_DELAY = 8.0  # Seconds; longer waits are better spent on the fallback engine
+
+class ProviderAPIError(Exception):
+    """Non-200 response from an AI provider"""
+    def __init__(self, message: str, status: int, retry_after: Optional[str] = None):
+        super().__init__(message)
+        self.status = status
+        self.retry_after = retry_after
+
+def _retry_delay(attempt: int, retry_after: Optional[str] = None) -> float:
+    """Seconds to wait before the next attempt: Retry-After if given, else jittered exponential backoff"""
+    if retry_after is not None:
+        try:
+            return min(float(retry_after), _MAX_RETRY_DELAY)
+        except ValueError:
+            pass  # HTTP-date form; use the backoff instead
+    return min(0.5 * 2 ** attempt, _MAX_RETRY_DELAY) * random.uniform(0.5, 1.5)
+
+class RealAITriageEngine:
+    """
+    Advanced AI-powered medical triage engine using real LLM APIs
+    """
+    
+    def __init__(self):
+        self.provider = settings.AI_MODEL_PROVIDER
+        self.openai_key = settings.OPENAI_API_KEY
+        self.anthropic_key = settings.ANTHROPIC_API_KEY
+        
+        # Validate API keys
+        if self.provider == "openai" and not self.openai_key:
+            raise ValueError("OpenAI API key not configured. Set OPENAI_API_KEY in environment.")
+        if self.provider == "anthropic" and not self.anthropic_key:
+            raise ValueError("Anthropic API key not configured. Set ANTHROPIC_API_KEY in environment.")
+        
+        # Shared HTTP session so TLS connections to the provider are kept alive between calls
+        self._session: Optional[aiohttp.ClientSession] = None
+        
+        # Provider calls in flight, keyed by prompt hash, so identical concurrent cases share one call
+        self._inflight: Dict[str, asyncio.Task] = {}
+        
+        # Caps outbound provider calls; the rest wait their turn instead of piling onto the API
+        self._semaphore = asyncio.Semaphore(settings.AI_MAX_CONCURRENCY)
+    
+    async def _get_session(self) -> aiohttp.ClientSession:
+        """Get the shared HTTP session, creating it on first use"""
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=100, ttl_dns_cache=300, keepalive_timeout=75),
+                timeout=aiohttp.ClientTimeout(total=settings.AI_ATTEMPT_TIMEOUT)
+            )
+        return self._session
+    
+    async def close(self):
+        """Close the shared HTTP session"""
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+    
+    def _build_medical_prompt(self, symptom_text: str, vitals: Dict, age: int, 
+                             pain_level: int, duration: str, comorbidities: List[str]) -> str:
+        """Build comprehensive medical prompt for AI analysis"""
+        get = vitals.get
+        
+        # Only the case details vary per request; the instructions are a prebuilt constant
+        return "\n".join([
+            "You are an expert emergency medicine physician AI assistant. Analyze this patient case and provide a comprehensive triage assessment.",
+            "",
+            "PATIENT INFORMATION:",
+            f"- Age: {age} years old",
+            f"- Pain Level: {pain_level}/10",
+            f"- Duration of Symptoms: {duration or 'Not specified'}",
+            f"- Pre-existing Conditions: {', '.join(comorbidities) if comorbidities else 'None reported'}",
+            "",
+            "CHIEF COMPLAINT & SYMPTOMS:",
+            symptom_text,
+            "",
+            "VITAL SIGNS:",
+            f"- Temperature: {get('temperature', 'Not recorded')}°C",
+            f"- Heart Rate: {get('heart_rate', 'Not recorded')} bpm",
+            f"- Blood Pressure: {get('blood_pressure_systolic', 'Not recorded')}/{get('blood_pressure_diastolic', 'Not recorded')} mmHg",
+            f"- Respiratory Rate: {get('respiratory_rate', 'Not recorded')} breaths/min",
+            f"- Oxygen Saturation: {get('oxygen_saturation', 'Not recorded')}%",
+            "",
+            _PROMPT_STATIC
+        ])
     
     async def analyze_with_openai(self, prompt: str) -> Dict:
         """Call OpenAI GPT-4 API"""
@@ -100,18 +153,36 @@ Provide top 3-5 differential diagnoses with probability estimates based on clini
             ],
             "temperature": settings.AI_TEMPERATURE,
             "max_tokens": settings.AI_MAX_TOKENS,
-            "response_format": {"type": "json_object"}
+            "response_format": {"type": "json_object"},
+            "stream": True
         }
         
-        async with aiohttp.ClientSession() as session:
-            async with session.post(url, headers=headers, json=payload) as response:
-                if response.status != 200:
-                    error_text = await response.text()
-                    raise Exception(f"OpenAI API Error {response.status}: {error_text}")
+        session = await self._get_session()
+        async with session.post(url, headers=headers, json=payload) as response:
+            if response.status != 200:
+                error_text = await response.text()
+                raise ProviderAPIError(
+                    f"OpenAI API Error {response.status}: {error_text}",
+                    response.status, response.headers.get('Retry-After')
+                )
+            
+            # Accumulate the streamed answer from the server-sent events as it is generated
+            chunks = []
+            async for line in response.content:
+                if not line.startswith(b'data: '):
+                    continue
+                data = line[6:].strip()
+                if data == b'[DONE]':
+                    break
                 
-                data = await response.json()
-                content = data['choices'][0]['message']['content']
-                return json.loads(content)
+                choices = orjson.loads(data).get('choices')
+                if not choices:
+                    continue
+                chunks.append(choices[0]['delta'].get('content') or '')
+                if choices[0].get('finish_reason'):
+                    break
+            
+            return orjson.loads(''.join(chunks))
     
     async def analyze_with_anthropic(self, prompt: str) -> Dict:
         """Call Anthropic Claude API"""
@@ -135,23 +206,68 @@ Provide top 3-5 differential diagnoses with probability estimates based on clini
             ]
         }
         
-        async with aiohttp.ClientSession() as session:
-            async with session.post(url, headers=headers, json=payload) as response:
-                if response.status != 200:
-                    error_text = await response.text()
-                    raise Exception(f"Anthropic API Error {response.status}: {error_text}")
-                
-                data = await response.json()
-                content = data['content'][0]['text']
-                
-                # Extract JSON from response (Claude sometimes adds explanatory text)
-                json_match = content
-                if '{' in content:
-                    start = content.index('{')
-                    end = content.rindex('}') + 1
-                    json_match = content[start:end]
-                
-                return json.loads(json_match)
+        session = await self._get_session()
+        async with session.post(url, headers=headers, json=payload) as response:
+            if response.status != 200:
+                error_text = await response.text()
+                raise ProviderAPIError(
+                    f"Anthropic API Error {response.status}: {error_text}",
+                    response.status, response.headers.get('Retry-After')
+                )
+            
+            data = orjson.loads(await response.read())
+            content = data['content'][0]['text']
+            
+            # Extract JSON from response (Claude sometimes adds explanatory text)
+            start = content.find('{')
+            if start != -1:
+                content = content[start:content.rfind('}') + 1]
+            
+            return orjson.loads(content)
+    
+    async def _call_provider(self, prompt: str) -> Dict:
+        """Call the configured provider, giving up after AI_REQUEST_DEADLINE seconds across all attempts"""
+        try:
+            return await asyncio.wait_for(self._call_with_retries(prompt), settings.AI_REQUEST_DEADLINE)
+        except asyncio.TimeoutError:
+            raise TimeoutError(f"AI provider gave no answer within {settings.AI_REQUEST_DEADLINE}s")
+    
+    async def _call_with_retries(self, prompt: str) -> Dict:
+        """Call the configured provider, at most AI_MAX_CONCURRENCY calls at a time, retrying transient failures"""
+        last_attempt = settings.AI_MAX_ATTEMPTS - 1
+        
+        for attempt in range(settings.AI_MAX_ATTEMPTS):
+            try:
+                async with self._semaphore:
+                    if self.provider == "openai":
+                        return await self.analyze_with_openai(prompt)
+                    else:  # anthropic
+                        return await self.analyze_with_anthropic(prompt)
+            except ProviderAPIError as e:
+                if e.status not in _RETRY_STATUSES or attempt == last_attempt:
+                    raise
+                delay = _retry_delay(attempt, e.retry_after)
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                if attempt == last_attempt:
+                    raise
+                delay = _retry_delay(attempt)
+            
+            # Back off outside the semaphore so the slot goes to another request meanwhile
+            print(f"⚠️ AI provider call failed, retrying in {delay:.1f}s (attempt {attempt + 2}/{settings.AI_MAX_ATTEMPTS})")
+            await asyncio.sleep(delay)
+    
+    async def analyze(self, prompt: str) -> Dict:
+        """Call the configured provider, joining an identical call already in flight"""
+        key = hashlib.blake2b(prompt.encode(), digest_size=16).hexdigest()
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.create_task(self._call_provider(prompt))
+            self._inflight[key] = task
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        
+        # Shield so one caller being cancelled doesn't cancel the call for the others
+        result = await asyncio.shield(task)
+        return copy.deepcopy(result)
     
     async def comprehensive_assessment(
         self,
@@ -181,10 +297,7 @@ Provide top 3-5 differential diagnoses with probability estimates based on clini
         
         # Call appropriate AI provider
         try:
-            if self.provider == "openai":
-                result = await self.analyze_with_openai(prompt)
-            else:  # anthropic
-                result = await self.analyze_with_anthropic(prompt)
+            result = await self.analyze(prompt)
             
             # Map API response to our format
             return {
@@ -209,8 +322,8 @@ Provide top 3-5 differential diagnoses with probability estimates based on clini
             # Log error and fall back to rule-based system if configured
             print(f"AI API Error: {str(e)}")
             if settings.USE_FALLBACK_AI:
-                from services.ai_engine import ai_engine
-                return ai_engine.predict_severity(symptom_text, vitals, duration)
+                from services.ai_engine import predict_severity_async
+                return await predict_severity_async(symptom_text, vitals, duration)
             else:
                 raise Exception(f"AI Analysis Failed: {str(e)}")
 
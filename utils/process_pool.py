@@ -0,0 +1,20 @@
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional
+import os
+
+# One process pool per app worker for CPU-bound work (symptom scoring, password hashing)
+_process_pool: Optional[ProcessPoolExecutor] = None
+
+def get_process_pool() -> ProcessPoolExecutor:
+    """Create the shared pool on first use"""
+    global _process_pool
+    if _process_pool is None:
+        _process_pool = ProcessPoolExecutor(max_workers=os.cpu_count())
+    return _process_pool
+
+def shutdown_process_pool():
+    """Stop the shared pool without waiting on queued work"""
+    global _process_pool
+    if _process_pool is not None:
+        _process_pool.shutdown(wait=False, cancel_futures=True)
+        _process_pool = None
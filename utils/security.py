@@ -1,25 +1,43 @@
 from datetime import datetime, timedelta
 from typing import Optional
-from jose import JWTError, jwt
+from hashlib import blake2b
+import asyncio
+import time
+from cachetools import TTLCache
+import jwt
+from jwt.exceptions import InvalidTokenError
 from passlib.context import CryptContext
 from fastapi import HTTPException, Security, Depends
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from config import settings
+from utils.process_pool import get_process_pool
 
 # Password hashing
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+pwd_context = CryptContext(schemes=["bcrypt"], bcrypt__rounds=settings.BCRYPT_ROUNDS, deprecated="auto")
 
-# Bearer token security
-security = HTTPBearer()
+# Bearer token security (missing credentials are rejected in get_current_user)
+security = HTTPBearer(auto_error=False)
 
-def hash_password(password: str) -> str:
-    """Hash a password"""
+# Verified token payloads by token hash; staleness is capped well below the token lifetime
+_token_cache: TTLCache = TTLCache(maxsize=10_000, ttl=60)
+
+# Run in pool workers, which import this module and use their own pwd_context
+def _hash(password: str) -> str:
     return pwd_context.hash(password)
 
-def verify_password(plain_password: str, hashed_password: str) -> bool:
-    """Verify a password against a hash"""
+def _verify(plain_password: str, hashed_password: str) -> bool:
     return pwd_context.verify(plain_password, hashed_password)
 
+async def hash_password(password: str) -> str:
+    """Hash a password (in the shared process pool)"""
+    return await asyncio.get_running_loop().run_in_executor(get_process_pool(), _hash, password)
+
+async def verify_password(plain_password: str, hashed_password: str) -> bool:
+    """Verify a password against a hash (in the shared process pool)"""
+    return await asyncio.get_running_loop().run_in_executor(
+        get_process_pool(), _verify, plain_password, hashed_password
+    )
+
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None) -> str:
     """Create a JWT access token"""
     to_encode = data.copy()
@@ -35,14 +53,24 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None) -
 
 def decode_access_token(token: str) -> dict:
     """Decode and verify a JWT token"""
+    key = blake2b(token.encode(), digest_size=16).digest()
+    cached = _token_cache.get(key)
+    if cached is not None and cached.get('exp', 0) > time.time():
+        return cached
+    
     try:
         payload = jwt.decode(token, settings.SECRET_KEY, algorithms=[settings.ALGORITHM])
-        return payload
-    except JWTError:
+    except InvalidTokenError:
         raise HTTPException(status_code=401, detail="Invalid authentication credentials")
+    
+    # Only tokens that verified are cached; the exp check above stops reuse past expiry
+    _token_cache[key] = payload
+    return payload
 
-async def get_current_user(credentials: HTTPAuthorizationCredentials = Security(security)) -> dict:
+async def get_current_user(credentials: Optional[HTTPAuthorizationCredentials] = Security(security)) -> dict:
     """Get current user from JWT token"""
+    if credentials is None or not credentials.credentials:
+        raise HTTPException(status_code=403, detail="Not authenticated")
     token = credentials.credentials
     payload = decode_access_token(token)
     